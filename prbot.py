@@ -2,23 +2,34 @@
 
 """Create pull requests to update GitHub repos that are using old versions of pom dependencies."""
 import argparse
-from contextlib import contextmanager
+import base64
 
 from datetime import date
 import datetime
+import difflib
+import hashlib
 import os
+import posixpath
+import random
 from dateutil.relativedelta import relativedelta
 import json
 import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import re
 import urllib
 import operator
+import Queue
 import requests
-from xml.etree import ElementTree
+from xml.parsers import expat
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
 import semantic_version
 import subprocess
 import shutil
+import threading
 import time
 
 
@@ -56,12 +67,55 @@ DEFAULT_HTTPS_URI = https_uri_from_domain(DEFAULT_DOMAIN)
 DEFAULT_SSH_URI = ssh_uri_from_domain(DEFAULT_DOMAIN)
 RESULTS_PER_PAGE = 100
 CLONE_DIR = 'repos'
+MIRROR_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'prbot', 'mirrors')
+MIRROR_CACHE_MB = 10 * 1024
+MIRROR_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+CLONE_FULL = 'full'
+CLONE_SHALLOW = 'shallow'  # Only the latest commit
+CLONE_SPARSE = 'sparse'  # Latest commit, only the blobs of the edited files
+CLONE_STRATEGIES = [CLONE_FULL, CLONE_SHALLOW, CLONE_SPARSE]
 LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
 DEFAULT_PUSHED_DATE = (date.today() + relativedelta(months=-1)).strftime('%Y-%m-%d')
 MAX_CMD_RETRIES = 10
-CLONE_RETRY_INTERVAL_SEC = 10
+CMD_RETRY_TIMEOUT_SEC = 300
+RETRY_INITIAL_DELAY_SEC = 0.5
+RETRY_MAX_DELAY_SEC = 30
+FORK_READY_TIMEOUT_SEC = 300
 REMINDER_INTERVAL_SECONDS = 7 * 24 * 60 * 60
 MAX_GITHUB_RESULTS_PAGE = 10  # Only the first 1000 search results are available
+MAX_SEARCH_RESULTS = MAX_GITHUB_RESULTS_PAGE * RESULTS_PER_PAGE
+GITHUB_EPOCH = date(2008, 1, 1)  # No repo was pushed to before GitHub launched
+SEARCH_SHARD_WORKERS = 4
+SEARCH_SHARD_MIN_SIZE_KB = 1024
+CORE_REQUESTS_PER_HOUR = 5000
+CORE_REQUESTS_BURST = 100
+SEARCH_REQUESTS_PER_MINUTE = 30
+MAX_RATE_LIMIT_RETRIES = 5
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT_SEC = 30
+HTTP_MAX_RETRIES = 3  # For connection errors and 5xx responses of idempotent requests
+HTTP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'prbot', 'http')
+HTTP_CACHE_MB = 100
+HTTP_CACHED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified', 'Link']
+DISCOVERY_WORKERS = 8
+DISCOVERY_SEARCH = 'search'  # GitHub code search and a raw download per repo
+DISCOVERY_INDEX = 'index'  # Local pom index of the mirrors
+DISCOVERY_MODES = [DISCOVERY_SEARCH, DISCOVERY_INDEX]
+POM_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'prbot', 'pom-index.json')
+POM_INDEX_FORMAT = 2  # Bump when the meaning of entries changes so old indexes are rebuilt
+DEFAULT_PLUGIN_GROUP_ID = 'org.apache.maven.plugins'
+PROPERTY_REFERENCE = re.compile(r'\$\{([^}]+)\}')
+MAX_PROPERTY_DEPTH = 10  # Guards against properties that reference each other in a cycle
+JOURNAL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'prbot', 'journals')
+FORKS_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'prbot', 'forks.json')
+# Stages of a repo in a campaign, in order
+STAGE_DISCOVERED = 'discovered'
+STAGE_FORKED = 'forked'
+STAGE_CLONED = 'cloned'
+STAGE_EDITED = 'edited'
+STAGE_PUSHED = 'pushed'
+STAGE_PR_CREATED = 'pr_created'
+STAGE_MENTIONED = 'mentioned'
 
 logger = logging.getLogger(__name__)
 log_handler = logging.StreamHandler()
@@ -80,9 +134,11 @@ def main():
                              'within the time specified by --pushed-date. '
                              'Overrides the --pushed-date flag.')
     parser.add_argument('--delete-forks', action='store_true',
-                        help='Delete your existing repository forks. This makes sure your fork '
-                             'is synced with the base repository and that your pull '
-                             'request doesn\'t have unintended commits.')
+                        help='Deprecated and ignored. Existing forks are reused, and pull request branches start '
+                             'at the tip of the base repository, so they don\'t have unintended commits.')
+    parser.add_argument('--forks-file', default=FORKS_PATH,
+                        help='File caching the upstream commit each fork was last synced to. '
+                             'Defaults to %s.' % FORKS_PATH)
     parser.add_argument('--at-mention-committers', action='store_true', help='@ mention recent committers.')
     parser.add_argument('--domain',
                         help='The GitHub or GitHub Enterprise domain. Defaults to %s.' % DEFAULT_DOMAIN)
@@ -93,10 +149,56 @@ def main():
                         help='The type of dependency. '
                              'Specify "--dep-type plugin" to replace outdated '
                              'plugins under build/plugins.')
+    parser.add_argument('--mirror-dir', default=MIRROR_DIR,
+                        help='Directory of persistent bare mirrors that clones borrow objects from. '
+                             'Defaults to %s.' % MIRROR_DIR)
+    parser.add_argument('--mirror-cache-mb', type=int, default=MIRROR_CACHE_MB,
+                        help='Disk budget of the mirror directory in megabytes. Least recently used mirrors '
+                             'are evicted beyond it. Defaults to %d.' % MIRROR_CACHE_MB)
+    parser.add_argument('--clone-strategy', choices=CLONE_STRATEGIES, default=CLONE_FULL,
+                        help='"shallow" clones only the latest commit. "sparse" also checks out and downloads '
+                             'only the pom being edited. Defaults to "%s".' % CLONE_FULL)
+    parser.add_argument('--http-cache-dir', default=HTTP_CACHE_DIR,
+                        help='Directory of cached GitHub responses that are revalidated with conditional requests. '
+                             'Defaults to %s.' % HTTP_CACHE_DIR)
+    parser.add_argument('--http-cache-mb', type=int, default=HTTP_CACHE_MB,
+                        help='Disk budget of the HTTP cache in megabytes. Defaults to %d.' % HTTP_CACHE_MB)
+    parser.add_argument('--no-http-cache', action='store_true', help='Do not cache GitHub responses.')
+    parser.add_argument('--shard-by-size', action='store_true',
+                        help='Also split the repo search by repo size when more than 1000 repos were pushed to on '
+                             'a single day, so that all of them are scanned.')
+    parser.add_argument('--search-cursor',
+                        help='Resume the search for recently pushed repos from this search results page URL. '
+                             'The URL of each page is logged as it\'s scanned.')
+    parser.add_argument('--discovery', choices=DISCOVERY_MODES, default=DISCOVERY_SEARCH,
+                        help='How to find repos with the outdated dependency. "search" uses GitHub code search, '
+                             'which only checks one pom per repo. "index" updates the mirror of each repo and looks '
+                             'the dependency up in a local index of all its poms, without any code search. '
+                             'Defaults to "%s".' % DISCOVERY_SEARCH)
+    parser.add_argument('--pom-index', default=POM_INDEX_PATH,
+                        help='File of the local pom index. Defaults to %s.' % POM_INDEX_PATH)
+    parser.add_argument('--discovery-workers', type=int, default=DISCOVERY_WORKERS,
+                        help='Number of repos to scan for the outdated dependency at the same time. All scans share '
+                             'the rate limits. Defaults to %d.' % DISCOVERY_WORKERS)
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the last campaign with the same commit message title where it stopped. Repos '
+                             'that were already scanned aren\'t scanned again, and each repo continues from the '
+                             'last stage it completed.')
+    parser.add_argument('--journal-dir', default=JOURNAL_DIR,
+                        help='Directory of the journals that record the progress of each campaign. '
+                             'Defaults to %s.' % JOURNAL_DIR)
+    parser.add_argument('--plan', metavar='PLAN_DIR',
+                        help='Only plan the campaign. Repos are discovered and their poms are patched in memory, '
+                             'but nothing is forked, pushed or commented on. The plan is written to plan.jsonl and '
+                             'the diffs of the patched poms to plan.diff in this directory.')
     parser.add_argument('-v', '--verbosity', action='count', default=0, help='Increase output verbosity.')
-    parser.add_argument('artifact_id',
+    parser.add_argument('--manifest',
+                        help='JSON file of dependency bumps to apply all at once instead of artifact_id and version, '
+                             'e.g. {"rules": [{"groupId": "com.spotify", "artifactId": "helios-testing", '
+                             '"version": "0.8.380", "depType": "dependency"}]}. groupId and depType are optional.')
+    parser.add_argument('artifact_id', nargs='?',
                         help='Artifact ID to use when creating helios job name. The default is to look in pom.xml')
-    parser.add_argument('version', help='Version of the artifact ID desired.')
+    parser.add_argument('version', nargs='?', help='Version of the artifact ID desired.')
     parser.add_argument('commit_message_file', help='File containing the Git commit message.')
     parser.add_argument('fork_owner', help='The owner of the git forks.')
     parser.add_argument('github_token', help='The personal access token of the owner of the git forks.')
@@ -106,20 +208,34 @@ def main():
     if args.verbosity > 0:
         logger.setLevel(logging.DEBUG)
 
-    if args.dep_type == 'plugin':
-        dep_parent = './build/plugins'
-        dep_children = 'plugin'
+    # Threads and git subprocesses all resolve these the same way, whatever directory they run in
+    for name in ('mirror_dir', 'http_cache_dir', 'pom_index', 'journal_dir', 'forks_file', 'plan'):
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    clone_dir = os.path.abspath(CLONE_DIR)
+
+    if args.delete_forks:
+        logger.warn('--delete-forks is deprecated and ignored. Forks are reused and synced with upstream.')
+
+    if args.manifest is not None:
+        try:
+            rules = load_manifest(args.manifest)
+        except (IOError, ValueError, KeyError) as e:
+            exit('Specify the path to a valid manifest.\n%s' % e)
+    elif args.artifact_id is not None and args.version is not None:
+        # Try to validate the version string. Script will exit if any exception is raised
+        rules = [DependencyRule(args.artifact_id, args.version, group_id=args.group_id, dep_type=args.dep_type)]
     else:
-        dep_parent = 'dependencies'
-        dep_children = 'dependency'
+        parser.error('Specify either artifact_id and version or --manifest.')
 
     # if args.domain is not None:
     base_url = base_url_from_domain(args.domain) if args.domain is not None else DEFAULT_BASE_URL
     https_uri = https_uri_from_domain(args.domain) if args.domain is not None else DEFAULT_HTTPS_URI
     api_url = args.api_url if args.api_url is not None else DEFAULT_API_URL
 
-    # Try to validate the version string. Script will exit if any exception is raised
-    semantic_version.Version(args.version)
+    github_client.authenticate(args.github_token)
+    if not args.no_http_cache:
+        github_client.cache = ResponseCache(args.http_cache_dir, args.http_cache_mb)
 
     try:
         commit_msg_title, commit_msg = parse_commit_message_file(args.commit_message_file)
@@ -128,118 +244,792 @@ def main():
 
     pr_branch = branch_name(commit_msg_title)
 
+    journal = CampaignJournal(os.path.join(args.journal_dir, '%s.jsonl' % pr_branch))
+    if args.resume:
+        journal.load()
+        logger.info('Resuming campaign %s with %d repos already scanned.', pr_branch, len(journal.repos()))
+    elif args.plan is None:
+        journal.clear()
+    finished_stage = STAGE_MENTIONED if args.at_mention_committers else STAGE_PR_CREATED
+    plan = CampaignPlan(args.plan) if args.plan is not None else None
+
     # Remind committers for open PRs
-    if args.at_mention_committers:
-        remind_prs(base_url, api_url, pr_branch, args.fork_owner, args.github_token)
+    if args.at_mention_committers and plan is None:
+        remind_prs(base_url, api_url, pr_branch, args.fork_owner)
 
     recently_pushed_repos = get_recently_pushed_repos(
         api_url, lang=args.language, pushed_date=args.pushed_date,
-        no_pushed_date=args.no_pushed_date)
-    logger.info('Number of repos recently pushed: %d', len(recently_pushed_repos))
+        no_pushed_date=args.no_pushed_date, cursor=args.search_cursor, shard_by_size=args.shard_by_size)
+
+    open_pulls, open_pulls_complete = get_open_pull_requests(api_url, args.fork_owner, pr_branch)
+    logger.info('Number of open pull requests from %s:%s: %d', args.fork_owner, pr_branch, len(open_pulls))
 
-    remove_dir(CLONE_DIR)
+    # Clones are cheap to recreate since their objects come from the mirrors.
+    remove_dir(clone_dir)
+    evict_mirrors(args.mirror_dir, args.mirror_cache_mb)
+    forks = ForkManager(args.forks_file)
+
+    def without_open_pulls(repos):
+        for r in repos:
+            if journal.done(r, STAGE_DISCOVERED):
+                continue
+            # See if there's already an open pull request for the repo from the same branch
+            open_pull = open_pulls.get((r, pr_branch))
+            if open_pull is not None:
+                logger.info('Already an open pull request for %s from %s:%s. See %s. Skipping.',
+                            r, args.fork_owner, pr_branch, open_pull['html_url'])
+                if plan is not None:
+                    plan.add_skip(r, 'open_pull', pull=open_pull['html_url'])
+                continue
+            yield r
 
     # search for the artifact ID in poms in each repo
-    for repo in recently_pushed_repos:
-        raw_url = find_outdated_pom_dependency(
-            base_url, api_url, repo, args.artifact_id, args.version, dep_parent,
-            dep_children, group_id=args.group_id)
-        if raw_url is None:
-            continue
+    pom_index = PomIndex(args.pom_index)
+    if args.discovery == DISCOVERY_INDEX:
+        outdated_poms = discover_outdated_poms_in_mirrors(
+            https_uri, without_open_pulls(recently_pushed_repos), pom_index, args.mirror_dir, rules,
+            workers=args.discovery_workers)
+    else:
+        # Repos indexed at their current master commit are answered from the index without a code search
+        pom_index.load()
+        outdated_poms = discover_outdated_poms(
+            base_url, api_url, without_open_pulls(recently_pushed_repos), rules, workers=args.discovery_workers,
+            index=pom_index)
+
+    if plan is not None:
+        try:
+            for repo, pom_paths in outdated_poms:
+                if not pom_paths:
+                    continue
+                # Discovery by index leaves an up to date mirror of the repo to read poms from
+                mirror_path = None
+                if args.discovery == DISCOVERY_INDEX:
+                    mirror_path = os.path.join(args.mirror_dir, '%s.git' % repo.replace('/', '_'))
+                plan_repo(plan, base_url, repo, pom_paths, rules, mirror_path=mirror_path)
+        finally:
+            plan.close()
+        logger.info('Wrote plan of campaign %s to %s.', pr_branch, args.plan)
+        return
 
+    def journaled_outdated_poms():
+        # Outdated repos that a resumed campaign already found come first, without scanning them again
+        for r in journal.repos():
+            found = journal.get(r, STAGE_DISCOVERED)
+            if found['paths'] and not journal.done(r, finished_stage):
+                yield r, found['paths']
+        for r, paths in outdated_poms:
+            journal.record(r, STAGE_DISCOVERED, paths=paths)
+            if paths:
+                yield r, paths
+
+    for repo, pom_paths in journaled_outdated_poms():
         repo_parts = repo.split('/')
         repo_owner = repo_parts[0]
         repo_name = repo_parts[1]
+        forked_repo = '%s/%s' % (args.fork_owner, repo_name)
 
-        # See if there's already an open pull request for the repo with the same title
-        # TODO (dxia) We are assuming any pull request for this repo from this fork owner is the relevant one.
-        pull_reqs = get_pull_requests(api_url, repo_owner, repo_name, branch=args.fork_owner + ':' + pr_branch)
-        if len(pull_reqs) > 0:
-            logger.info('Already an open pull request for %s/%s from %s/%s:%s. See %s. Skipping.',
-                        repo_owner, repo_name, args.fork_owner, repo_name, pr_branch,
-                        pull_reqs[0]['html_url'])
+        pr_number = journal.get(repo, STAGE_PR_CREATED, {}).get('pr_number')
+        if pr_number is None:
+            # The index of open pull requests misses some if there were more than search returns
+            if not open_pulls_complete and not journal.done(repo, STAGE_PUSHED):
+                pull_reqs = get_pull_requests(api_url, repo_owner, repo_name,
+                                              branch=args.fork_owner + ':' + pr_branch)
+                if len(pull_reqs) > 0:
+                    logger.info('Already an open pull request for %s/%s from %s/%s:%s. See %s. Skipping.',
+                                repo_owner, repo_name, args.fork_owner, repo_name, pr_branch,
+                                pull_reqs[0]['html_url'])
+                    continue
+
+            # Fork repo
+            if not journal.done(repo, STAGE_FORKED):
+                # Returns the existing fork if there is one
+                if not fork_repo(api_url, repo_owner, repo_name):
+                    exit('Couldn\'t fork repository %s to owner %s.' % (repo, args.fork_owner))
+                journal.record(repo, STAGE_FORKED)
+
+            if not journal.done(repo, STAGE_PUSHED):
+                # GitHub forks asynchronously. Wait until the fork has refs to clone.
+                if not wait_for_fork(https_uri, args.fork_owner, repo_name):
+                    exit('Fork %s was not ready after %d seconds.' % (forked_repo, FORK_READY_TIMEOUT_SEC))
+                # Fetch upstream into the persistent mirror so the clone of the fork only needs to download
+                # objects the mirror doesn't have. Shallow clones download little enough that a full mirror
+                # isn't worth it.
+                mirror_path = None
+                if args.clone_strategy == CLONE_FULL:
+                    mirror_path = update_mirror(https_uri, repo_owner, repo_name, args.mirror_dir)
+                # Check out all poms since versions may be defined by properties in parent poms
+                repo_clone_path = clone_repo(https_uri, args.fork_owner, repo_name, clone_dir, retry=True,
+                                             reference=mirror_path, strategy=args.clone_strategy,
+                                             patterns=['pom.xml'])
+                if repo_clone_path is None:
+                    exit('Failed to clone repo %s/%s.', args.fork_owner, repo_name)
+                # Start the pull request branch at upstream's tip, since the fork may be behind
+                if not sync_fork_with_upstream(repo_clone_path, api_url, repo, forked_repo, forks,
+                                               strategy=args.clone_strategy, mirror_path=mirror_path):
+                    logger.warn('Couldn\'t sync fork %s with %s. Skipping.', forked_repo, repo)
+                    continue
+                journal.record(repo, STAGE_CLONED)
+
+                # Apply every rule to every outdated pom so the repo gets all its bumps in one commit
+                edits = update_poms(repo_clone_path, pom_paths, rules)
+                edited_paths = []
+                for edit in edits:
+                    logger.info('Edited %s in file "%s" of repo %s from %s to %s.',
+                                edit.element, edit.path, repo, edit.old, edit.new)
+                    if edit.path not in edited_paths:
+                        edited_paths.append(edit.path)
+                if not edited_paths:
+                    continue
+                journal.record(repo, STAGE_EDITED, paths=edited_paths)
+
+                # Git commit files and push to Github
+                branch_add_commit_push(edited_paths, pr_branch, commit_msg, repo_clone_path)
+                logger.info('Pushed new branch %s to repo %s.', pr_branch, forked_repo)
+                journal.record(repo, STAGE_PUSHED)
+
+            pr_number = create_pull_request(
+                api_url, repo_owner, repo_name,
+                pull_request_title(commit_msg_title),
+                '%s:%s' % (args.fork_owner, pr_branch), body=commit_msg)
+
+            if pr_number is None:
+                exit('Couldn\'t create pull request from head repo %s:%s to base repo %s.'
+                     % (forked_repo, pr_branch, repo))
+            journal.record(repo, STAGE_PR_CREATED, pr_number=pr_number)
+
+            pr_url = '%s%s/pull/%d' % (base_url, repo, pr_number)
+            logger.info('Created pull request. See %s.', pr_url)
+
+        if args.at_mention_committers and not journal.done(repo, STAGE_MENTIONED):
+            at_mention_recent_committers(base_url, api_url, repo, pr_number, args.fork_owner)
+            journal.record(repo, STAGE_MENTIONED)
+
+
+def update_poms(repo_path, pom_paths, rules):
+    """
+    Bump every dependency in poms of a repo that a rule finds outdated. Versions defined by a property are bumped
+    where the property is defined, which may be a parent pom. Only the edited values are replaced so the rest of
+    each pom keeps its formatting.
+    Return a list of the applied PomEdit.
+    :param repo_path:
+    :param pom_paths: Paths of the poms to check, relative to repo_path
+    :param rules: List of DependencyRule
+    :return:
+    """
+    def read(path):
+        try:
+            with open(os.path.join(repo_path, path)) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    applied = []
+    for path, _, text, file_applied in patch_poms(PomSet(read), pom_paths, rules):
+        # All the edits of a file are written at once
+        with open(os.path.join(repo_path, path), 'wb') as f:
+            f.write(text)
+        applied.extend(file_applied)
+    return applied
+
+
+def patch_poms(poms, pom_paths, rules):
+    """
+    Find the edits that bump every outdated dependency in poms of a repo and apply them in memory.
+    Return a list of (path, original text, patched text, list of applied PomEdit) of each patched pom.
+    :param poms: PomSet
+    :param pom_paths: Paths of the poms to check
+    :param rules: List of DependencyRule
+    :return:
+    """
+    edits_by_path = OrderedDict()
+    for edit in find_pom_edits(poms, pom_paths, rules):
+        edits_by_path.setdefault(edit.path, []).append(edit)
+
+    patches = []
+    for path, file_edits in edits_by_path.items():
+        pom = poms.get(path)
+        text, applied = patch_pom(pom, file_edits)
+        if not applied:
             continue
+        if not verify_pom_patch(pom, text, applied):
+            logger.warn('Patched file "%s" doesn\'t have the expected values. Not editing it.', path)
+            continue
+        patches.append((path, pom.text, text, applied))
+    return patches
 
-        # Fork repo
-        forked_repo = '%s/%s' % (args.fork_owner, repo_name)
 
-        if args.delete_forks:
-            logger.info('Deleting your fork %s if it exists.', forked_repo)
-            status = delete_repo(api_url, args.fork_owner, repo_name, args.github_token)
-            if status == requests.codes.no_content:
-                logger.info('Successfully deleted your fork "%s/%s".', args.fork_owner, repo_name)
+def plan_repo(plan, base_url, repo, pom_paths, rules, mirror_path=None):
+    """
+    Add the patches of the outdated poms of a repo to a campaign plan without changing anything.
+    :param plan: CampaignPlan
+    :param base_url:
+    :param repo: Repo in the form of 'owner/repo'
+    :param pom_paths: Paths of the outdated poms
+    :param rules: List of DependencyRule
+    :param mirror_path: Mirror of the repo to read poms from. They're read from GitHub without one.
+    :return:
+    """
+    if mirror_path is not None and os.path.isdir(mirror_path):
+        def read(path):
+            return read_blobs(mirror_path, 'refs/heads/master', [path])[0]
+    else:
+        read = master_file_reader(base_url, repo)
+
+    patches = patch_poms(PomSet(read), pom_paths, rules)
+    if not patches:
+        plan.add_skip(repo, 'no_edits')
+    for path, text, new_text, applied in patches:
+        plan.add_edit(repo, path, text, new_text,
+                      edits=[{'element': e.element, 'old': e.old, 'new': e.new} for e in applied])
+
+
+class CampaignPlan(object):
+    """
+    Plan of a campaign written instead of running it. plan.jsonl has a JSON line with the repo, file, action and
+    diff hunks of every file that would be edited, and a line for every repo that would be skipped. plan.diff has
+    the unified diffs of all edits with the repo in the file names.
+    """
+
+    def __init__(self, plan_dir):
+        if not os.path.isdir(plan_dir):
+            os.makedirs(plan_dir)
+        self.plan_file = open(os.path.join(plan_dir, 'plan.jsonl'), 'w')
+        self.diff_file = open(os.path.join(plan_dir, 'plan.diff'), 'w')
+        self.lock = threading.Lock()
+
+    def add_edit(self, repo, path, text, new_text, **data):
+        """
+        Add the edit of a file of a repo to the plan.
+        :param repo:
+        :param path:
+        :param text: Contents of the file before the edit
+        :param new_text: Contents of the file after the edit
+        :param data: Extra fields of the plan entry
+        :return:
+        """
+        diff = list(difflib.unified_diff(text.splitlines(True), new_text.splitlines(True),
+                                         'a/%s/%s' % (repo, path), 'b/%s/%s' % (repo, path)))
+        hunks = []
+        for line in diff[2:]:
+            if line.startswith('@@'):
+                hunks.append({'header': line.rstrip('\n'), 'lines': []})
             else:
-                logger.info('Couldn\'t delete your fork "%s/%s". Got status code %d.'
-                            % (args.fork_owner, repo_name, status))
-
-        if not fork_repo(api_url, repo_owner, repo_name, args.github_token):
-            exit('Couldn\'t fork repository %s to owner %s.' % (repo, args.fork_owner))
-
-        # Sleep to give GitHub enough time to fork.
-        time.sleep(CLONE_RETRY_INTERVAL_SEC)
-        repo_clone_path = clone_repo(https_uri, args.fork_owner, repo_name, CLONE_DIR, retry=True)
-        if repo_clone_path is None:
-            exit('Failed to clone repo %s/%s.', args.fork_owner, repo_name)
-
-        file_path = file_path_from_html_url(raw_url)
-        if file_path is None:
-            logger.info('File "%s" no longer exists in the master branch of repo %s. Skipping.',
-                        file_path, repo_clone_path)
+                hunks[-1]['lines'].append(line.rstrip('\n'))
+        entry = dict(data, repo=repo, file=path, action='edit', hunks=hunks)
+        with self.lock:
+            self.plan_file.write(json.dumps(entry) + '\n')
+            self.diff_file.writelines(line if line.endswith('\n') else line + '\n\\ No newline at end of file\n'
+                                      for line in diff)
+
+    def add_skip(self, repo, reason, **data):
+        """
+        Add a repo that the campaign would skip to the plan.
+        :param repo:
+        :param reason:
+        :param data: Extra fields of the plan entry
+        :return:
+        """
+        entry = dict(data, repo=repo, file=None, action='skip', reason=reason)
+        with self.lock:
+            self.plan_file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        self.plan_file.close()
+        self.diff_file.close()
+
+
+def patch_pom(pom, edits):
+    """
+    Replace the values of the edited elements of a pom at the byte offsets found when it was scanned, so each edit
+    changes exactly the element it was made for and nothing else in the pom.
+    Return the patched text and a list of the applied PomEdit. Edits whose element doesn't hold the expected value
+    or overlaps another edit aren't applied.
+    :param pom: Pom
+    :param edits: List of PomEdit of the pom
+    :return:
+    """
+    applied = []
+    last_end = -1
+    for edit in sorted(edits, key=lambda e: e.span or (-1, -1)):
+        if edit.span is None or pom.text[edit.span[0]:edit.span[1]] != edit.old:
+            logger.warn('Couldn\'t find %s with value %s in file "%s". Not editing it.',
+                        edit.element, edit.old, pom.path)
             continue
+        if edit.span[0] < last_end:
+            logger.warn('Edit of %s in file "%s" overlaps another edit. Not editing it.', edit.element, pom.path)
+            continue
+        last_end = edit.span[1]
+        applied.append(edit)
 
-        repo_file_path = os.path.join(repo_clone_path, file_path)
+    # Splice from the end of the pom so the offsets of the remaining edits stay valid
+    text = pom.text
+    for edit in reversed(applied):
+        start, end = edit.span
+        text = text[:start] + edit.new + text[end:]
+    return text, applied
 
-        with open(repo_file_path.decode('ascii')) as f:
-            pom_text = f.read()
 
-        pom_root = ElementTree.XML(pom_text)
+def verify_pom_patch(pom, text, edits):
+    """
+    Scan a patched pom and check that the edited elements have their new values and that no other version or
+    property changed.
+    :param pom: Pom before the patch
+    :param text: Patched text of the pom
+    :param edits: List of applied PomEdit
+    :return: True if the patched pom is as expected
+    """
+    try:
+        patched = Pom(pom.path, text)
+    except expat.ExpatError as e:
+        logger.warn('Could not parse patched file "%s".\n%s', pom.path, e)
+        return False
 
-        deps = pom_root.find(dep_parent)
-        if deps is None:
-            logger.warn('Couldn\'t find any dependencies in pom.xml in at %s.', repo_file_path)
-            continue
+    expected_versions = dict((xpath, version) for _, _, version, xpath in pom.artifacts)
+    expected_properties = dict(pom.properties)
+    for edit in edits:
+        if edit.element in expected_properties:
+            expected_properties[edit.element] = edit.new
+        else:
+            expected_versions[edit.element] = edit.new
+
+    versions = dict((xpath, version) for _, _, version, xpath in patched.artifacts)
+    return versions == expected_versions and patched.properties == expected_properties
 
-        for j in deps.findall(dep_children):
-            artifact_id_el = j.find('artifactId')
-            version_string_el = j.find('version')
-            group_id_el = j.find('groupId')
 
-            if artifact_id_el is None or artifact_id_el.text != args.artifact_id or version_string_el is None:
+def find_pom_edits(poms, pom_paths, rules):
+    """
+    Evaluate all rules against the dependencies and plugins of poms and their parents in the repo, including the
+    ones in dependencyManagement and pluginManagement. Versions are resolved through properties of the pom and its
+    parents.
+    Return a list of PomEdit that bump every outdated version, with one edit per edited element.
+    :param poms: PomSet
+    :param pom_paths: Paths of the poms to check
+    :param rules: List of DependencyRule
+    :return:
+    """
+    edits = OrderedDict()  # (path, element) -> PomEdit
+
+    # Dependencies without a version are managed by a parent, so check the parents too
+    checked_poms = OrderedDict()
+    for path in pom_paths:
+        pom = poms.get(path)
+        if pom is None:
+            logger.info('File "%s" doesn\'t exist or isn\'t a valid pom. Skipping.', path)
+        while pom is not None and pom.path not in checked_poms:
+            checked_poms[pom.path] = pom
+            pom = poms.parent_of(pom)
+
+    for path, pom in checked_poms.items():
+        for group_id, artifact_id, version, xpath in pom.artifacts:
+            rule = next((r for r in rules if r.matches(poms.resolve(pom, group_id)[0], artifact_id, xpath)), None)
+            if rule is None:
                 continue
 
-            version_string = version_string_el.text
-            if semantic_version.Version(version_string) >= semantic_version.Version(args.version):
+            resolved, definition = poms.resolve(pom, version)
+            try:
+                if not rule.is_outdated(resolved):
+                    continue
+            except ValueError:
+                logger.debug('Skipping version %s of %s in %s that isn\'t a semantic version.',
+                             resolved, artifact_id, path)
                 continue
 
-            if args.group_id is not None and group_id_el is not None and args.group_id != group_id_el.text:
+            if definition is not None:
+                defining_pom, name = definition
+                edit = PomEdit(defining_pom.path, name, resolved, rule.version, rule,
+                               defining_pom.property_spans.get(name))
+            elif PROPERTY_REFERENCE.search(version):
+                logger.info('Version %s of %s in %s isn\'t defined in one place. Not editing it.',
+                            version, artifact_id, path)
                 continue
+            else:
+                edit = PomEdit(path, xpath, version, rule.version, rule, pom.spans.get(xpath))
 
-            logger.info('File "%s" on master branch of repo %s has %s version %s. Editing...',
-                        file_path, repo, args.artifact_id, version_string)
+            key = (edit.path, edit.element)
+            if key in edits and edits[key].new != edit.new:
+                logger.warn('Rules for %s and %s both bump %s in %s. Using the first one.',
+                            edits[key].rule.artifact_id, rule.artifact_id, edit.element, edit.path)
+                continue
+            edits[key] = edit
 
-            new_pom_text = pom_text.replace('<version>%s</version>' % version_string_el.text,
-                                            '<version>%s</version>' % args.version, 1)
-            with open(repo_file_path, 'w') as f:
-                f.write(new_pom_text)
+    return list(edits.values())
 
-            # Git commit file and push to Github
-            branch_add_commit_push(file_path, pr_branch, commit_msg, repo_clone_path)
-            logger.info('Pushed new branch %s to repo %s.', pr_branch, forked_repo)
 
-            pr_number = create_pull_request(
-                api_url, repo_owner, repo_name, args.github_token,
-                pull_request_title(commit_msg_title),
-                '%s:%s' % (args.fork_owner, pr_branch), body=commit_msg)
+class PomEdit(object):
+    """
+    Replacement of the value of one element in a pom, either a version element or a property.
+    """
 
-            if pr_number is None:
-                exit('Couldn\'t create pull request from head repo %s:%s to base repo %s.'
-                     % (forked_repo, pr_branch, repo))
+    def __init__(self, path, element, old, new, rule, span):
+        self.path = path
+        self.element = element  # Property name or XPath of a version element
+        self.old = old
+        self.new = new
+        self.rule = rule
+        self.span = span  # Byte offsets (start, end) of the value in the pom or None if the element is empty
 
-            pr_url = '%s%s/pull/%d' % (base_url, repo, pr_number)
-            logger.info('Created pull request. See %s.', pr_url)
 
-            if args.at_mention_committers:
-                at_mention_recent_committers(base_url, api_url, repo, pr_number, args.fork_owner, args.github_token)
+class Pom(object):
+    """
+    Model of a pom: its coordinates, parent, properties and the version of every dependency and plugin.
+    The pom is scanned as a stream of elements with expat rather than parsed into a tree, so only the coordinates
+    are kept in memory. Elements are matched by their local name, so poms that declare the Maven POM namespace are
+    read the same as poms without one.
+    """
+
+    # Child elements that hold the coordinates of a pom, dependency or plugin
+    COORDINATES = ('groupId', 'artifactId', 'version')
+
+    def __init__(self, path, text):
+        self.path = path
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.text = text
+        self.group_id = None
+        self.artifact_id = None
+        self.version = None
+        self.parent = {}  # groupId, artifactId, version and relativePath of the parent element
+        self.properties = {}
+        # (groupId, artifactId, version, XPath of the version element) of every dependency and plugin with a version
+        self.artifacts = []
+        # Byte offsets (start, end) in text of the stripped value of every version element in artifacts by XPath
+        self.spans = {}
+        # Byte offsets (start, end) in text of the stripped value of every property by name
+        self.property_spans = {}
+        self.scan()
+
+    def scan(self):
+        """
+        Scan the pom and fill in its coordinates, parent, properties, artifacts and spans.
+        :return:
+        """
+        parser = expat.ParserCreate(namespace_separator='}')
+        parser.returns_unicode = False  # Values are patched into text, which is UTF-8 bytes
+        stack = []
+
+        def start_element(tag, _):
+            name = local_name(tag)
+            parent = stack[-1] if stack else None
+            if parent:
+                parent['positions'][name] = parent['positions'].get(name, 0) + 1
+                xpath = '%s/%s[%d]' % (parent['xpath'], name, parent['positions'][name])
+            else:
+                xpath = '/%s' % name
+            stack.append({
+                'name': name,
+                'xpath': xpath,
+                'positions': {},
+                'fields': {} if name in ('dependency', 'plugin') else None,
+                'text': [] if self.is_captured(name, [frame['name'] for frame in stack]) else None,
+                'start': None,
+            })
+
+        def character_data(data):
+            frame = stack[-1]
+            if frame['text'] is not None:
+                if frame['start'] is None:
+                    frame['start'] = parser.CurrentByteIndex
+                frame['text'].append(data)
+
+        def end_element(_):
+            frame = stack.pop()
+            if frame['fields'] is not None:
+                self.add_artifact(frame)
+            if frame['text'] is None:
+                return
+
+            value = ''.join(frame['text']).strip()
+            span = self.value_span(frame['start'], parser.CurrentByteIndex)
+            parent = stack[-1]
+            if parent['fields'] is not None:
+                parent['fields'][frame['name']] = (value, span)
+            elif parent['name'] == 'parent':
+                self.parent[frame['name']] = value
+            elif parent['name'] == 'properties':
+                self.properties[frame['name']] = value
+                self.property_spans[frame['name']] = span
+            else:
+                setattr(self, {'groupId': 'group_id', 'artifactId': 'artifact_id', 'version': 'version'}[frame['name']],
+                        value)
+
+        parser.StartElementHandler = start_element
+        parser.CharacterDataHandler = character_data
+        parser.EndElementHandler = end_element
+        parser.Parse(self.text, True)
+
+    def is_captured(self, name, ancestors):
+        """
+        Return True if the text of an element is part of the coordinates of the pom.
+        :param name: Local name of the element
+        :param ancestors: Local names of the ancestors of the element starting with the root
+        :return:
+        """
+        if len(ancestors) == 1:
+            return name in self.COORDINATES
+        if len(ancestors) == 2 and ancestors[1] in ('parent', 'properties'):
+            return True
+        return bool(ancestors) and ancestors[-1] in ('dependency', 'plugin') and name in self.COORDINATES
+
+    def value_span(self, start, end):
+        """
+        Return the byte offsets of the stripped content of an element or None if the element is self-closing.
+        :param start: Byte offset of the first character data of the element or None if it has none
+        :param end: Byte offset of the end tag of the element, or just past the element if it's self-closing
+        :return:
+        """
+        if start is None:
+            if self.text.endswith('/>', 0, end):
+                return None
+            start = end
+        content = self.text[start:end]
+        return start + len(content) - len(content.lstrip()), end - len(content) + len(content.rstrip())
+
+    def add_artifact(self, frame):
+        """
+        Add a dependency or plugin element to artifacts if it has an artifactId and a version.
+        :param frame: Scanner state of the element
+        :return:
+        """
+        fields = frame['fields']
+        artifact_id = fields.get('artifactId', ('', None))[0]
+        version, span = fields.get('version', ('', None))
+        if artifact_id and version:
+            group_id = fields.get('groupId', ('', None))[0] or \
+                (DEFAULT_PLUGIN_GROUP_ID if frame['name'] == 'plugin' else '')
+            xpath = frame['xpath'] + '/version'
+            self.artifacts.append((group_id, artifact_id, version, xpath))
+            self.spans[xpath] = span
+
+
+def local_name(tag):
+    """
+    Return an XML tag without its namespace.
+    :param tag:
+    :return:
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+class PomSet(object):
+    """
+    The poms of one repo, parsed as they're needed. Resolves ${property} references through the properties of a pom
+    and its parent chain inside the repo.
+    """
+
+    def __init__(self, read):
+        """
+        :param read: Function that takes the path of a file in the repo and returns its contents or None
+        """
+        self.read = read
+        self.poms = {}
+
+    def get(self, path):
+        """
+        Return the Pom at path or None if it doesn't exist or can't be parsed.
+        :param path:
+        :return:
+        """
+        if path not in self.poms:
+            pom = None
+            text = self.read(path)
+            if text is not None:
+                try:
+                    pom = Pom(path, text)
+                except expat.ExpatError as e:
+                    logger.warn('Could not parse %s.\n%s', path, e)
+            self.poms[path] = pom
+        return self.poms[path]
+
+    def parent_of(self, pom):
+        """
+        Return the parent Pom of a pom if it's in the same repo.
+        :param pom:
+        :return:
+        """
+        if not pom.parent:
+            return None
+        relative_path = pom.parent.get('relativePath', '../pom.xml')
+        if not relative_path:
+            # An empty relativePath means the parent is only looked up in repositories
+            return None
+        if not relative_path.endswith('.xml'):
+            relative_path = posixpath.join(relative_path, 'pom.xml')
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(pom.path), relative_path))
+        if path.startswith('../'):
+            return None
+
+        parent = self.get(path)
+        if parent is None or parent.artifact_id != pom.parent.get('artifactId'):
+            return None
+        return parent
+
+    def resolve(self, pom, value, depth=0):
+        """
+        Resolve the ${property} references in a value of pom.
+        Return a tuple of the resolved value and, if the value is a single reference to a property that's defined in
+        a pom, a tuple of that Pom and the name of the property whose value to edit. Unresolved references are left
+        as they are.
+        :param pom: Pom the value is from
+        :param value:
+        :param depth:
+        :return:
+        """
+        m = PROPERTY_REFERENCE.match(value)
+        if m is None or m.end() != len(value) or depth > MAX_PROPERTY_DEPTH:
+            # A literal or several references, e.g. 1.${minor}. Resolve it, but it isn't defined in one place.
+            if depth > MAX_PROPERTY_DEPTH:
+                return value, None
+            return PROPERTY_REFERENCE.sub(lambda r: self.resolve(pom, r.group(0), depth + 1)[0], value), None
+
+        name = m.group(1)
+        defining_pom = pom
+        while defining_pom is not None and name not in defining_pom.properties:
+            defining_pom = self.parent_of(defining_pom)
+        if defining_pom is None:
+            return self.builtin_property(pom, name, value), None
+
+        # Properties are resolved in the context of the pom they're used in, since it may override them
+        resolved, definition = self.resolve(pom, defining_pom.properties[name], depth + 1)
+        return resolved, definition or (defining_pom, name)
+
+    def builtin_property(self, pom, name, default):
+        """
+        Return the value of a built-in property of the project's coordinates, or default.
+        :param pom:
+        :param name:
+        :param default:
+        :return:
+        """
+        if name in ('project.version', 'pom.version', 'version'):
+            return pom.version or pom.parent.get('version') or default
+        if name in ('project.groupId', 'pom.groupId', 'groupId'):
+            return pom.group_id or pom.parent.get('groupId') or default
+        if name in ('project.parent.version', 'parent.version'):
+            return pom.parent.get('version') or default
+        if name in ('project.parent.groupId', 'parent.groupId'):
+            return pom.parent.get('groupId') or default
+        return default
+
+
+class DependencyRule(object):
+    """
+    Bump of a dependency or plugin in poms to a target version.
+    """
+
+    def __init__(self, artifact_id, version, group_id=None, dep_type='dependency'):
+        self.artifact_id = artifact_id
+        self.version = version
+        self.group_id = group_id
+        self.dep_type = dep_type
+        self.minimum_version = semantic_version.Version(version)
+        # XPaths without positions of the version elements this rule edits
+        if dep_type == 'plugin':
+            self.version_xpaths = ['/project/build/plugins/plugin/version',
+                                   '/project/build/pluginManagement/plugins/plugin/version']
+        else:
+            self.version_xpaths = ['/project/dependencies/dependency/version',
+                                   '/project/dependencyManagement/dependencies/dependency/version']
+
+    def is_outdated(self, version_string):
+        return semantic_version.Version(version_string) < self.minimum_version
+
+    def matches(self, group_id, artifact_id, xpath):
+        """
+        Return whether the rule applies to a dependency or plugin.
+        :param group_id: Resolved groupId, empty if the element has none
+        :param artifact_id:
+        :param xpath: XPath of the version element
+        :return:
+        """
+        if artifact_id != self.artifact_id or re.sub(r'\[\d+\]', '', xpath) not in self.version_xpaths:
+            return False
+        return self.group_id is None or not group_id or group_id == self.group_id
+
+
+def load_manifest(file_path):
+    """
+    Read a list of DependencyRule from a JSON manifest, either a list of rules or an object with a "rules" list.
+    Each rule has an artifactId and a version, and optionally a groupId and a depType of "dependency" or "plugin".
+    :param file_path:
+    :return:
+    """
+    with open(file_path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest['rules']
+    return [DependencyRule(rule['artifactId'], rule['version'], group_id=rule.get('groupId'),
+                           dep_type=rule.get('depType', 'dependency'))
+            for rule in manifest]
+
+
+class CampaignJournal(object):
+    """
+    Append-only JSON lines file recording the stages each repo of a campaign completed, so an interrupted campaign
+    can resume where it stopped. Each line is one completed stage of one repo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = OrderedDict()  # repo -> {stage: data}
+        self.lock = threading.Lock()
+
+    def load(self):
+        line = ''
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line is partial if a run died while writing it
+                        continue
+                    self.stages.setdefault(entry['repo'], {})[entry['stage']] = entry['data']
+        except IOError:
+            return
+        if line and not line.endswith('\n'):
+            # Terminate a partial last line so the next record starts on its own line
+            with open(self.path, 'a') as f:
+                f.write('\n')
+
+    def clear(self):
+        """
+        Start a new journal.
+        :return:
+        """
+        with self.lock:
+            self.stages.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def record(self, repo, stage, **data):
+        """
+        Durably record that repo completed a stage.
+        :param repo:
+        :param stage:
+        :param data: JSON serializable details of the stage, e.g. the PR number
+        :return:
+        """
+        with self.lock:
+            self.stages.setdefault(repo, {})[stage] = data
+            parent = os.path.dirname(self.path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'repo': repo, 'stage': stage, 'data': data}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def done(self, repo, stage):
+        with self.lock:
+            return stage in self.stages.get(repo, {})
+
+    def get(self, repo, stage, default=None):
+        with self.lock:
+            return self.stages.get(repo, {}).get(stage, default)
+
+    def repos(self):
+        with self.lock:
+            return list(self.stages.keys())
 
 
 def remove_dir(dir_name):
@@ -281,76 +1071,434 @@ def file_path_from_html_url(github_master_file_url):
         return m.group(1)
 
 
-def branch_add_commit_push(file_path, git_branch_name, commit_msg, base_path=None):
+def branch_add_commit_push(file_paths, git_branch_name, commit_msg, base_path=None):
     """
-    Git commit a file. cd to base_path if not None.
-    :param file_path:
+    Git commit files in the repo at base_path if not None.
+    :param file_paths: Paths relative to base_path
     :param git_branch_name:
     :param commit_msg:
     :param base_path:
     :return:
     """
     if base_path is not None:
-        with in_dir(base_path):
-            run_cmd(['git', 'checkout', '-b', git_branch_name], stderr=subprocess.STDOUT)
-            run_cmd(['git', 'add', file_path], stderr=subprocess.STDOUT)
-            run_cmd(['git', 'commit', '-m', commit_msg], stderr=subprocess.STDOUT)
-            run_cmd(['git', 'push', '-f', '--set-upstream', 'origin', git_branch_name],
-                    stderr=subprocess.STDOUT)
+        run_cmd(['git', 'checkout', '-b', git_branch_name], stderr=subprocess.STDOUT, cwd=base_path)
+        run_cmd(['git', 'add'] + file_paths, stderr=subprocess.STDOUT, cwd=base_path)
+        run_cmd(['git', 'commit', '-m', commit_msg], stderr=subprocess.STDOUT, cwd=base_path)
+        run_cmd(['git', 'push', '-f', '--set-upstream', 'origin', git_branch_name],
+                stderr=subprocess.STDOUT, retry=True, cwd=base_path)
     return True
 
 
-def run_cmd(cmd_parts, stderr=None, retry=False):
+def run_cmd(cmd_parts, stderr=None, retry=False, cwd=None):
     """
     Run a shell command. cmd_parts must be a list of strings.
     :param cmd_parts:
     :param stderr:
-    :param retry:
+    :param retry: Retry failures with jittered exponential backoff. The last error is raised
+                  once retries or the deadline run out.
+    :param cwd: Directory to run the command in. Use this instead of changing the process's working directory so
+                discovery threads don't race with it.
     :return:
     """
     logger.info('%s "%s"', 'Running command', ' '.join(cmd_parts))
 
-    success = False
     retries = 0
-    output = None
+    deadline = time.time() + CMD_RETRY_TIMEOUT_SEC
+    delays = backoff_delays()
 
-    while not success and retries < MAX_CMD_RETRIES:
+    while True:
         try:
-            output = subprocess.check_output(cmd_parts, stderr=stderr)
-            success = True
+            return subprocess.check_output(cmd_parts, stderr=stderr, cwd=cwd)
         except subprocess.CalledProcessError as e:
             if not retry:
                 raise e
-            logger.info('Failed to run command. Retries: %d of %d.',  retries, MAX_CMD_RETRIES)
-            output = e.message
             retries += 1
-            time.sleep(CLONE_RETRY_INTERVAL_SEC)
+            delay = next(delays)
+            if retries >= MAX_CMD_RETRIES or time.time() + delay > deadline:
+                logger.info('Failed to run command. Giving up after %d retries.', retries)
+                raise e
+            logger.info('Failed to run command. Retries: %d of %d. Retrying in %.1f seconds.',
+                        retries, MAX_CMD_RETRIES, delay)
+            time.sleep(delay)
+
 
-    return output
+def backoff_delays(initial=RETRY_INITIAL_DELAY_SEC, maximum=RETRY_MAX_DELAY_SEC):
+    """
+    Yield an endless series of exponentially growing delays in seconds.
+    Each delay is jittered so that retries of many repos don't fire in lockstep.
+    :param initial: Upper bound of the first delay
+    :param maximum: Upper bound of any delay
+    :return:
+    """
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2.0, delay)
+        delay = min(delay * 2, maximum)
 
 
-@contextmanager
-def in_dir(path):
+def wait_until(predicate, timeout):
     """
-    Switch to a path, do something, then switch back.
-    :param path:
+    Call predicate with exponential backoff until it returns True or timeout seconds have passed.
+    Return whether predicate returned True.
+    :param predicate: Function taking no arguments
+    :param timeout: Overall deadline in seconds
     :return:
     """
-    saved_path = os.getcwd()
-    try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(saved_path)
+    deadline = time.time() + timeout
+    for delay in backoff_delays():
+        if predicate():
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+
+
+def wait_for_fork(https_uri, owner, repo, timeout=FORK_READY_TIMEOUT_SEC):
+    """
+    Wait until a newly created fork can be cloned by polling its refs with `git ls-remote`,
+    which is much cheaper than a clone. Return whether the fork became ready before the deadline.
+    :param https_uri:
+    :param owner:
+    :param repo:
+    :param timeout: Overall deadline in seconds
+    :return:
+    """
+    repo_uri = '%s/%s/%s' % (https_uri, owner, repo)
+
+    def has_refs():
+        try:
+            output = run_cmd(['git', 'ls-remote', '--heads', repo_uri], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return False
+        return bool(output.strip())
+
+    return wait_until(has_refs, timeout)
+
 
+class RateLimitBucket(object):
+    """
+    Token bucket that paces requests counted against one GitHub rate limit, e.g. the core or the search limit.
+    It starts out with the default limit and window of github.com, then follows the rate limit headers of each
+    response: the capacity scales with X-RateLimit-Limit and the requests left are spread evenly until
+    X-RateLimit-Reset. When the limit is used up it pauses until the limit resets, and when a secondary rate limit
+    is hit it pauses for as long as Retry-After asks.
+    """
+
+    def __init__(self, limit, window_sec, burst):
+        self.window_sec = window_sec
+        # Share of the limit that may be sent at once
+        self.burst_ratio = float(burst) / limit
+        self.requests_per_sec = float(limit) / window_sec
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now >= self.paused_until:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.requests_per_sec)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.requests_per_sec
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def release(self):
+        """
+        Give back the token of a request that didn't count against the rate limit.
+        :return:
+        """
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def update(self, response):
+        """
+        Adjust the bucket to the rate limit headers of a response.
+        :param response: requests.Response
+        :return:
+        """
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        limit = response.headers.get('X-RateLimit-Limit')
+        reset = response.headers.get('X-RateLimit-Reset')
+        retry_after = response.headers.get('Retry-After')
+
+        with self.lock:
+            if limit is not None:
+                self.burst = max(1, int(int(limit) * self.burst_ratio))
+                self.requests_per_sec = float(limit) / self.window_sec
+            if remaining is not None:
+                # Never burst past what GitHub says is left
+                self.tokens = min(self.tokens, self.burst, int(remaining))
+                if reset is not None:
+                    if int(remaining) == 0:
+                        self.paused_until = max(self.paused_until, int(reset) + 1)
+                    else:
+                        # Spread the requests left over the rest of the window
+                        self.requests_per_sec = int(remaining) / max(1.0, int(reset) - time.time())
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.time() + int(retry_after))
+
+
+class RateLimiter(object):
+    """
+    Token buckets for the core and search rate limits, which GitHub counts separately.
+    """
+
+    def __init__(self):
+        self.core = RateLimitBucket(CORE_REQUESTS_PER_HOUR, 3600, CORE_REQUESTS_BURST)
+        self.search = RateLimitBucket(SEARCH_REQUESTS_PER_MINUTE, 60, SEARCH_REQUESTS_PER_MINUTE)
+
+    def bucket_for(self, url):
+        """
+        Return the bucket of the rate limit that a request to url counts against.
+        :param url:
+        :return:
+        """
+        return self.search if '/search/' in url else self.core
+
+
+def is_rate_limited(response):
+    """
+    Return whether a GitHub API response was rejected because of a primary or secondary rate limit.
+    :param response: requests.Response
+    :return:
+    """
+    if response.status_code not in (requests.codes.forbidden, requests.codes.too_many_requests):
+        return False
+    return 'Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0'
+
+
+class GitHubClient(object):
+    """
+    GitHub API client that keeps pooled keep-alive connections in one requests.Session, so that calls don't each
+    pay for a new TCP and TLS handshake. Requests are scheduled around the rate limits, and ones that are rejected
+    because of a rate limit are retried once the limit allows instead of failing.
+    """
 
-def fork_repo(api_url, owner, repo, token, organization=None):
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT_SEC, max_retries=HTTP_MAX_RETRIES, cache=None):
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter()
+        self.cache = cache
+        self.identity = 'anonymous'
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        # Retry only idempotent methods so that e.g. a fork or PR isn't created twice. Once retries run out, the last
+        # response is returned to the caller's status handling instead of raising RetryError.
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=max_retries, backoff_factor=RETRY_INITIAL_DELAY_SEC,
+                                                status_forcelist=[500, 502, 503, 504], raise_on_status=False))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def authenticate(self, token):
+        """
+        Authenticate all following requests with a personal access token.
+        :param token:
+        :return:
+        """
+        self.session.auth = HTTPBasicAuth(token, 'x-oauth-basic')
+        # Cached responses are only shared between runs with the same token. Don't store the token itself.
+        self.identity = hashlib.sha1(token).hexdigest()
+
+    def request(self, method, url, **kwargs):
+        """
+        Send an API request once the rate limit allows it. Return the requests.Response.
+        :param method:
+        :param url:
+        :param kwargs: Passed to requests.Session.request
+        :return:
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self.rate_limiter.bucket_for(url)
+        for _ in range(MAX_RATE_LIMIT_RETRIES):
+            bucket.acquire()
+            r = self.session.request(method, url, **kwargs)
+            bucket.update(r)
+            if r.status_code == requests.codes.not_modified:
+                # GitHub doesn't count 304s against the rate limit
+                bucket.release()
+            if not is_rate_limited(r):
+                return r
+            logger.warn('Rate limited on %s. Queueing the request until the limit allows it.', r.url)
+        return r
+
+    def get_cached(self, url, params=None):
+        """
+        GET a read-only API resource. If it's cached, revalidate it with a conditional request.
+        :param url:
+        :param params:
+        :return: requests.Response
+        """
+        def send(headers):
+            return self.request('GET', url, params=params, headers=headers)
+
+        if self.cache is None:
+            return send({})
+        return self.cache.get(self.identity, url, params, send)
+
+    def get_raw(self, url):
+        """
+        Download a raw file. These downloads don't count against the API rate limits.
+        :param url:
+        :return: requests.Response
+        """
+        def send(headers):
+            return self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if self.cache is None:
+            return send({})
+        return self.cache.get(self.identity, url, None, send)
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of GET responses keyed by URL and auth identity. Cached responses are revalidated with
+    If-None-Match and If-Modified-Since, and a 304 response is answered from the cache. When the cache grows beyond
+    its disk budget, the least recently used responses are evicted.
+    """
+
+    def __init__(self, cache_dir, max_mb):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.size = None
+        self.lock = threading.Lock()
+
+    def get(self, identity, url, params, send):
+        """
+        Return a requests.Response for url, from the cache if it's still fresh.
+        :param identity: Identifies the credentials the request is sent with
+        :param url:
+        :param params: Query parameters
+        :param send: Function that takes a dict of extra headers and sends the request
+        :return:
+        """
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        path = os.path.join(self.cache_dir, hashlib.sha1('%s %s' % (identity, full_url)).hexdigest() + '.json')
+        entry = self.load(path)
+
+        headers = {}
+        if entry is not None:
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        r = send(headers)
+
+        if r.status_code == requests.codes.not_modified and entry is not None:
+            logger.debug('%s not modified. Using cached response.', full_url)
+            # Mark the entry as recently used for LRU eviction.
+            os.utime(path, None)
+            return response_from_entry(entry)
+        if r.status_code == requests.codes.ok and ('ETag' in r.headers or 'Last-Modified' in r.headers):
+            self.store(path, r)
+        return r
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def store(self, path, response):
+        entry = {
+            'url': response.url,
+            'encoding': response.encoding,
+            'headers': dict((h, response.headers[h]) for h in HTTP_CACHED_HEADERS if h in response.headers),
+            'content': base64.b64encode(response.content),
+        }
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+        # Write to a temporary file and rename it so concurrent readers never see a partial entry.
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = dir_size(self.cache_dir)
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is back under 90% of its budget.
+        :return:
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+
+def response_from_entry(entry):
+    """
+    Build a requests.Response from a cache entry.
+    :param entry:
+    :return:
+    """
+    r = requests.Response()
+    r.status_code = requests.codes.ok
+    r.url = entry['url']
+    r.encoding = entry['encoding']
+    r.headers = CaseInsensitiveDict(entry['headers'])
+    r._content = base64.b64decode(entry['content'])
+    return r
+
+
+github_client = GitHubClient()
+
+
+def github_request(method, url, **kwargs):
+    """
+    Send a GitHub API request through the shared client.
+    :param method:
+    :param url:
+    :param kwargs: Passed to requests.Session.request
+    :return: requests.Response
+    """
+    return github_client.request(method, url, **kwargs)
+
+
+def fork_repo(api_url, owner, repo, organization=None):
     """
     Fork a repo from owner/repo to organization.
     :param api_url:
     :param owner:
     :param repo:
-    :param token:
     :param organization:
     :return:
     """
@@ -358,8 +1506,7 @@ def fork_repo(api_url, owner, repo, token, organization=None):
     if organization is not None:
         data = json.dumps({'organization': organization})
 
-    r = requests.post('%srepos/%s/%s/forks' % (api_url, owner, repo), data=data,
-                      auth=HTTPBasicAuth(token, 'x-oauth-basic'))
+    r = github_request('POST', '%srepos/%s/%s/forks' % (api_url, owner, repo), data=data)
     if r.status_code == requests.codes.accepted:
         return True
     else:
@@ -367,26 +1514,25 @@ def fork_repo(api_url, owner, repo, token, organization=None):
         return False
 
 
-def create_pull_request(api_url, owner, repo, token, title, head, base='master', body=None):
+def create_pull_request(api_url, owner, repo, title, head, base='master', body=None):
     """
     Create a GitHub pull request and return the pull request number if successful.
     None if not successful.
     :param api_url:
     :param owner:
     :param repo:
-    :param token:
     :param title:
     :param head:
     :param base:
     :param body:
     :return:
     """
-    r = requests.post('%srepos/%s/%s/pulls' % (api_url, owner, repo), data=json.dumps({
+    r = github_request('POST', '%srepos/%s/%s/pulls' % (api_url, owner, repo), data=json.dumps({
         'title': title,
         'head': head,
         'base': base,
         'body': body,
-    }), auth=HTTPBasicAuth(token, 'x-oauth-basic'))
+    }))
 
     if r.status_code != requests.codes.created:
         return None
@@ -395,77 +1541,260 @@ def create_pull_request(api_url, owner, repo, token, title, head, base='master',
     return response.get('number', None)
 
 
-def delete_repo(api_url, owner, repo, token):
-    """
-    Delete git repo.
-    :param api_url:
-    :param owner:
-    :param repo:
-    :param token:
-    :return:
-    """
-    r = requests.delete('%srepos/%s/%s' % (api_url, owner, repo),
-                        auth=HTTPBasicAuth(token, 'x-oauth-basic'))
-    return r.status_code
-
-
 def get_recently_pushed_repos(api_url, lang=None, pushed_date=None,
-                              no_pushed_date=False):
+                              no_pushed_date=False, cursor=None, shard_by_size=False,
+                              workers=SEARCH_SHARD_WORKERS):
     """
-    Get a list of repos in the form of 'owner/repo' that were recently pushed, i.e. updated.
+    Generate repos in the form of 'owner/repo' that were recently pushed, i.e. updated.
+    Search only returns the first 1000 results, so the pushed date range is split into shards that each match fewer
+    than that. See plan_repo_search. The shards are searched in parallel and each repo is generated once, as soon as
+    its page of search results has been fetched.
     :param api_url:
     :param lang:
     :param pushed_date:
     :param no_pushed_date: If true, do not limit search to repos pushed to
                            since specified date.
+    :param cursor: URL of the search results page to resume from. It's logged for each page and already contains
+                   the query, so the other filters are ignored.
+    :param shard_by_size: Also split the shards of single days by repo size if they match 1000 repos or more.
+    :param workers: Number of shards to search at the same time.
     :return:
     """
-    query_str = ''
+    if cursor is not None:
+        for page_url, results in search_pages(cursor):
+            logger.info('Scanning repos from search results page %s', page_url)
+            for item in results['items']:
+                yield item['full_name']
+        return
 
-    if not no_pushed_date:
-        if pushed_date:
-            query_str = 'pushed:>%s' % pushed_date
-        else:
-            query_str = 'pushed:>%s' % DEFAULT_PUSHED_DATE
+    if no_pushed_date:
+        since = GITHUB_EPOCH
+    else:
+        since = datetime.datetime.strptime(pushed_date or DEFAULT_PUSHED_DATE, '%Y-%m-%d').date() \
+            + datetime.timedelta(days=1)
+    # GitHub dates pushes in UTC, which may be a day ahead of local time
+    shard = SearchShard(since, datetime.datetime.utcnow().date(), lang=lang)
+
+    def shard_pages(shard_and_first_page):
+        shard_url, first_page = shard_and_first_page
+        for page_url, results in search_pages(shard_url, first_page):
+            logger.info('Scanning repos from search results page %s', page_url)
+            yield [item['full_name'] for item in results['items']]
+
+    seen = set()
+    shards = plan_repo_search(api_url, shard, shard_by_size, workers)
+    for repos in merge_in_threads(shard_pages, shards, workers):
+        for repo in repos:
+            # Repos pushed to during the scan can move to another shard
+            if repo not in seen:
+                seen.add(repo)
+                yield repo
+
+
+def merge_in_threads(generator_func, args, workers):
+    """
+    Run a generator function for each of args in worker threads and generate the items of all of them as they're
+    produced, in no particular order. Only a few items per worker are buffered, so workers wait for the caller
+    instead of running ahead of it. An exception in a worker is raised to the caller.
+    :param generator_func: Function that takes one of args and returns a generator
+    :param args: Iterable of arguments, consumed as workers become free
+    :param workers: Number of generators to run at the same time
+    :return:
+    """
+    items = Queue.Queue(maxsize=workers * 2)
+    stopped = threading.Event()
+    done = object()
+
+    def put(error, item):
+        # Give up once the caller stopped reading so that workers don't block forever
+        while not stopped.is_set():
+            try:
+                items.put((error, item), timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
 
-    if lang:
-        query_str += '+language:%s' % lang
+    def drain(arg):
+        for item in generator_func(arg):
+            if not put(None, item):
+                return
 
-    r = requests.get('%ssearch/repositories?q=%s&sort=updated&per_page=%d'
-                     % (api_url, urllib.quote(query_str, '/+'),
-                        RESULTS_PER_PAGE))
+    def pending_args():
+        for arg in args:
+            if stopped.is_set():
+                return
+            yield arg
 
-    results = json.loads(r.text)
+    def feed():
+        pool = ThreadPool(workers)
+        try:
+            for _ in pool.imap_unordered(drain, pending_args()):
+                pass
+            put(done, None)
+        except Exception as e:
+            put(e, None)
+        finally:
+            pool.terminate()
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        while True:
+            error, item = items.get()
+            if error is done:
+                return
+            if error is not None:
+                raise error
+            yield item
+    finally:
+        stopped.set()
+        feeder.join()
 
-    total_count = results['total_count']
-    total_pages = total_count / RESULTS_PER_PAGE
-    if total_count % RESULTS_PER_PAGE > 0:
-        total_pages += 1
 
-    curr_page = 1
-    recently_pushed_repos = []
+class SearchShard(object):
+    """
+    Part of a repo search restricted to a range of pushed dates and optionally a range of repo sizes in KB.
+    """
 
-    for item in results['items']:
-        recently_pushed_repos.append(item['full_name'])
+    def __init__(self, pushed_from, pushed_to, size_from=None, size_to=None, lang=None):
+        self.pushed_from = pushed_from
+        self.pushed_to = pushed_to
+        self.size_from = size_from
+        self.size_to = size_to  # None means unbounded
+        self.lang = lang
+
+    def query(self):
+        """
+        Return the search query string, with qualifiers joined by '+'.
+        :return:
+        """
+        query_str = 'pushed:%s..%s' % (self.pushed_from.isoformat(), self.pushed_to.isoformat())
+        if self.size_to is not None:
+            query_str += '+size:%d..%d' % (self.size_from, self.size_to)
+        elif self.size_from is not None:
+            query_str += '+size:>=%d' % self.size_from
+        if self.lang:
+            query_str += '+language:%s' % self.lang
+        return query_str
+
+    def split(self, by_size=False):
+        """
+        Return two shards that together cover this one, or None if it can't be split any further.
+        Date ranges are halved until they're a single day. Then size ranges are halved if by_size is set.
+        :param by_size:
+        :return:
+        """
+        days = (self.pushed_to - self.pushed_from).days
+        if days > 0:
+            middle = self.pushed_from + datetime.timedelta(days=days / 2)
+            return [SearchShard(self.pushed_from, middle, self.size_from, self.size_to, self.lang),
+                    SearchShard(middle + datetime.timedelta(days=1), self.pushed_to, self.size_from, self.size_to,
+                                self.lang)]
+
+        if not by_size:
+            return None
+        size_from = self.size_from or 0
+        if self.size_to is None:
+            # Repo sizes are unbounded, so grow the bounded part first
+            middle = max(size_from * 2, SEARCH_SHARD_MIN_SIZE_KB)
+        elif self.size_to > size_from:
+            middle = (size_from + self.size_to) / 2
+        else:
+            return None
+        return [SearchShard(self.pushed_from, self.pushed_to, size_from, middle, self.lang),
+                SearchShard(self.pushed_from, self.pushed_to, middle + 1, self.size_to, self.lang)]
 
-    while curr_page < min(MAX_GITHUB_RESULTS_PAGE, total_pages):
-        curr_page += 1
-        r = requests.get('%ssearch/repositories?q=%s&sort=updated&per_page=%d&page=%d'
-                         % (api_url, urllib.quote(query_str, '/+'),
-                            RESULTS_PER_PAGE, curr_page))
 
-        if r.status_code == requests.codes.forbidden:
-            j = json.loads(r.text)
-            logger.warn('%s: %s.', j['message'], j['documentation_url'])
-            return recently_pushed_repos
-        elif r.status_code != requests.codes.ok:
-            logger.warn('%s returned status code %d.', r.url, r.status_code)
+def repo_search_url(api_url, query_str):
+    """
+    Return the URL of the first page of a repo search sorted by last update.
+    :param api_url:
+    :param query_str:
+    :return:
+    """
+    return '%ssearch/repositories?q=%s&sort=updated&per_page=%d' % (
+        api_url, urllib.quote(query_str, '/+'), RESULTS_PER_PAGE)
 
-        results = json.loads(r.text)
-        for item in results['items']:
-            recently_pushed_repos.append(item['full_name'])
 
-    return recently_pushed_repos
+def plan_repo_search(api_url, shard, by_size, workers=SEARCH_SHARD_WORKERS):
+    """
+    Recursively split a repo search into shards that each match fewer than the 1000 results search returns.
+    The first page of each shard tells how many repos it matches. Shards of the same depth are fetched in parallel,
+    and the first page of every shard that's not split any further is reused to search it.
+    Generate tuples of (URL of the shard's first page, first page's requests.Response).
+    :param api_url:
+    :param shard: SearchShard
+    :param by_size: See SearchShard.split
+    :param workers: Number of first pages to fetch at the same time.
+    :return:
+    """
+    def fetch_first_page(s):
+        url = repo_search_url(api_url, s.query())
+        return s, url, github_request('GET', url)
+
+    pool = ThreadPool(workers)
+    try:
+        frontier = [shard]
+        while frontier:
+            next_frontier = []
+            for s, url, r in pool.imap_unordered(fetch_first_page, frontier):
+                if r.status_code != requests.codes.ok:
+                    logger.warn('%s returned status code %d. Skipping this part of the search.', url, r.status_code)
+                    continue
+
+                total_count = r.json()['total_count']
+                halves = s.split(by_size) if total_count >= MAX_SEARCH_RESULTS else None
+                if halves is not None:
+                    logger.debug('Search for %s matches %d repos. Splitting it.', s.query(), total_count)
+                    next_frontier.extend(halves)
+                    continue
+
+                if total_count >= MAX_SEARCH_RESULTS:
+                    logger.warn('Search for %s matches %d repos. Only the first %d are scanned.',
+                                s.query(), total_count, MAX_SEARCH_RESULTS)
+                yield url, r
+            frontier = next_frontier
+    finally:
+        pool.terminate()
+
+
+def search_pages(url, first_page=None):
+    """
+    Generate tuples of (page URL, parsed results) for each page of a search by following the Link rel="next"
+    headers. The next page is requested while the caller works on the current one.
+    Stop at the first page that doesn't return 200, e.g. once the rate limit retries are used up.
+    :param url: URL of the first page
+    :param first_page: requests.Response of the first page if it's already been fetched
+    :return:
+    """
+    pool = ThreadPool(1)
+    try:
+        pending = None
+        if first_page is None:
+            pending = pool.apply_async(github_request, ('GET', url))
+        while first_page is not None or pending is not None:
+            if first_page is not None:
+                r, first_page = first_page, None
+            else:
+                r = pending.get()
+            if r.status_code != requests.codes.ok:
+                logger.warn('%s returned status code %d. Stopping the search at this page.', url, r.status_code)
+                return
+            results = r.json()
+
+            next_link = r.links.get('next')
+            if next_link is None:
+                pending = None
+            else:
+                pending = pool.apply_async(github_request, ('GET', next_link['url']))
+
+            yield url, results
+            if next_link is not None:
+                url = next_link['url']
+    finally:
+        pool.terminate()
 
 
 def search_in_repo(api_url, repo, string, lang=None):
@@ -480,7 +1809,7 @@ def search_in_repo(api_url, repo, string, lang=None):
     query = '%s repo:%s' % (string, repo)
     if lang is not None:
         query += ' language:"%s"' % lang
-    r = requests.get('%ssearch/code?q=%s' % (api_url, urllib.quote(query)))
+    r = github_request('GET', '%ssearch/code?q=%s' % (api_url, urllib.quote(query)))
     return json.loads(r.text)
 
 
@@ -495,10 +1824,43 @@ def get_pull_requests(api_url, owner, repo, branch=None):
     """
     url = '%srepos/%s/%s/pulls' % (api_url, owner, repo)
     params = None if branch is None else {'head': branch}
-    r = requests.get(url, params=params)
+    r = github_client.get_cached(url, params=params)
     return json.loads(r.text)
 
 
+def get_open_pull_requests(api_url, author, branch):
+    """
+    Index all open pull requests by author from branch with one paginated issue search instead of one request per
+    repo. Return a dict of (base repo in the form of 'owner/repo', head branch) -> search result item, and whether
+    the index is complete. Search only returns the first 1000 results.
+    :param api_url:
+    :param author:
+    :param branch:
+    :return:
+    """
+    query = 'type:pr state:open author:%s head:%s' % (author, branch)
+    open_pulls = {}
+    total_count = 0
+    page = 1
+
+    while page <= MAX_GITHUB_RESULTS_PAGE:
+        r = github_request('GET', '%ssearch/issues' % api_url,
+                           params={'q': query, 'per_page': RESULTS_PER_PAGE, 'page': page})
+        if r.status_code != requests.codes.ok:
+            logger.warn('%s returned status code %d.', r.url, r.status_code)
+            return open_pulls, False
+        results = json.loads(r.text)
+        total_count = results['total_count']
+        for item in results['items']:
+            repo = '/'.join(item['repository_url'].split('/')[-2:])
+            open_pulls[(repo, branch)] = item
+        if len(results['items']) < RESULTS_PER_PAGE:
+            break
+        page += 1
+
+    return open_pulls, len(open_pulls) >= total_count
+
+
 def get_recent_committers(api_url, repo):
     """
     Get recent committers for repo ordered by frequency of commits descending.
@@ -506,7 +1868,7 @@ def get_recent_committers(api_url, repo):
     :param repo:
     :return:
     """
-    r = requests.get('%srepos/%s/commits' % (api_url, repo))
+    r = github_client.get_cached('%srepos/%s/commits' % (api_url, repo))
     if r.status_code != requests.codes.ok:
         logger.error('Could not get list of commits from repo "%s". Returning empty list for recent committers.', repo)
         return []
@@ -523,18 +1885,17 @@ def get_recent_committers(api_url, repo):
     return [c[0] for c in sorted(recent_committers.items(), key=operator.itemgetter(1), reverse=True)]
 
 
-def comment_on_issue(api_url, repo, issue_number, comment, token):
+def comment_on_issue(api_url, repo, issue_number, comment):
     """
     Comment on an issue.
     :param api_url:
     :param repo:
     :param issue_number:
     :param comment:
-    :param token:
     :return:
     """
-    r = requests.post('%srepos/%s/issues/%d/comments' % (api_url, repo, issue_number),
-                      data=json.dumps({'body': comment}), auth=HTTPBasicAuth(token, 'x-oauth-basic'))
+    r = github_request('POST', '%srepos/%s/issues/%d/comments' % (api_url, repo, issue_number),
+                       data=json.dumps({'body': comment}))
     return r.status_code == requests.codes.created
 
 
@@ -558,70 +1919,475 @@ def branch_name(string):
     return s[:15]
 
 
-def find_outdated_pom_dependency(
-        base_url, api_url, repo, dependency, minimum_version, target_parent,
-        target_children, group_id=None):
+def find_outdated_pom_dependency(base_url, api_url, repo, rules, index=None):
     """
-    Search GitHub in the repo for the dependency.
-    Return None if we cannot find a version of it less than the specified minimum version.
-    Otherwise return a string of the raw file's URL.
+    Search GitHub in the repo for the poms with any dependency that a rule finds outdated.
+    Return a list of the paths of outdated poms on the master branch, empty if there are none.
     :param base_url:
     :param api_url:
     :param repo:
-    :param dependency:
-    :param minimum_version:
-    :param target_parent: The name of the XML element under which to search
-    :param target_children: The name of the XML elements to search
-    :param group_id: Optional group ID to limit searches to.
+    :param rules: List of DependencyRule
+    :param index: Optional PomIndex. If it has indexed the repo at its current master commit, it's used instead of
+                  searching GitHub.
     :return:
     """
     logger.info('Scanning repo %s...', repo)
 
-    result = search_in_repo(api_url, repo, dependency, lang='Maven POM')
+    if index is not None:
+        sha = get_master_sha(api_url, repo)
+        if sha is not None and sha == index.indexed_sha(repo):
+            logger.debug('Repo %s is unchanged since it was indexed at %s.', repo, sha)
+            return find_outdated_in_index(index, repo, rules)
+
+    # Search for each rule's artifact separately so every pom that mentions one of them is checked
+    pom_paths = []
+    for artifact_id in OrderedDict.fromkeys(rule.artifact_id for rule in rules):
+        result = search_in_repo(api_url, repo, artifact_id, lang='Maven POM')
+        for item in result.get('items', []):
+            file_path = file_path_from_html_url(html_url_to_raw_url(base_url, item['html_url']))
+            if file_path is not None and file_path not in pom_paths:
+                pom_paths.append(file_path)
 
     # Skip if no matches.
-    if len(result['items']) < 1:
-        return None
+    if not pom_paths:
+        return []
+
+    # Parent poms that define properties are read from the same branch
+    poms = PomSet(master_file_reader(base_url, repo))
+    outdated_paths = []
+    for file_path in pom_paths:
+        edits = find_pom_edits(poms, [file_path], rules)
+        for edit in edits:
+            logger.info('According to the search index, repo %s has %s version %s in %s',
+                        repo, edit.rule.artifact_id, edit.old, edit.path)
+        if edits:
+            outdated_paths.append(file_path)
+    return outdated_paths
+
+
+def master_file_reader(base_url, repo):
+    """
+    Return a function that takes the path of a file in a repo and returns its raw contents on the master branch or
+    None if it doesn't exist.
+    :param base_url:
+    :param repo:
+    :return:
+    """
+    def read(path):
+        r = github_client.get_raw('%sraw/%s/master/%s' % (base_url, repo, path))
+        if r.status_code != requests.codes.ok:
+            return None
+        return r.content
+    return read
+
 
-    html_url = result['items'][0]['html_url']
-    raw_url = html_url_to_raw_url(base_url, html_url)
-    xml = requests.get(raw_url).text
+def find_outdated_in_index(index, repo, rules):
+    """
+    Return a list of the paths of the poms of a repo with any dependency that a rule finds outdated, according to
+    the pom index.
+    :param index: PomIndex
+    :param repo:
+    :param rules: List of DependencyRule
+    :return:
+    """
+    paths = []
+    for rule in rules:
+        for _, path, _, version, _ in index.find_outdated(rule.artifact_id, rule.version, group_id=rule.group_id,
+                                                          repo=repo, xpaths=rule.version_xpaths):
+            logger.info('According to the pom index, repo %s has %s version %s in %s',
+                        repo, rule.artifact_id, version, path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def discover_outdated_poms(base_url, api_url, repos, rules, workers=DISCOVERY_WORKERS, index=None):
+    """
+    Scan repos for outdated dependencies with find_outdated_pom_dependency, at most workers repos at a time.
+    Scanning is almost all waiting on GitHub, so the scans overlap their requests. They all go through
+    github_client and so share one rate limit budget.
+    Yield a tuple of (repo, paths of outdated poms) as soon as each repo is scanned. The list of paths is empty if
+    the repo isn't outdated.
+    :param base_url:
+    :param api_url:
+    :param repos: Iterable of repos in the form of 'owner/repo'
+    :param rules: List of DependencyRule
+    :param workers:
+    :param index: Optional PomIndex, see find_outdated_pom_dependency.
+    :return:
+    """
+    def scan(repo):
+        return repo, find_outdated_pom_dependency(base_url, api_url, repo, rules, index=index)
+
+    pool = ThreadPool(workers)
+    try:
+        for repo, paths in pool.imap_unordered(scan, repos):
+            yield repo, paths
+    finally:
+        pool.terminate()
+
+
+def discover_outdated_poms_in_mirrors(https_uri, repos, index, mirror_dir, rules, workers=DISCOVERY_WORKERS):
+    """
+    Like discover_outdated_poms, but find outdated dependencies in a local index of every pom on the master branch
+    of each repo's mirror instead of with GitHub code search. Only repos whose master branch moved since they were
+    indexed have their mirror updated and re-indexed, at most workers repos at a time. The index is saved when the
+    generator is done or closed.
+    Yield a tuple of (repo, paths of outdated poms) as soon as each repo is scanned. The list of paths is empty if
+    the repo isn't outdated.
+    :param https_uri:
+    :param repos: Iterable of repos in the form of 'owner/repo'
+    :param index: PomIndex
+    :param mirror_dir:
+    :param rules: List of DependencyRule
+    :param workers:
+    :return:
+    """
+    def scan(repo):
+        owner, name = repo.split('/')
+        # Only fetch and re-parse repos whose master branch moved since they were indexed
+        sha = remote_master_sha(https_uri, owner, name)
+        if sha is None or sha != index.indexed_sha(repo):
+            mirror_path = update_mirror(https_uri, owner, name, mirror_dir)
+            if mirror_path is not None:
+                index_mirror(index, repo, mirror_path)
+        else:
+            logger.debug('Repo %s is unchanged since it was indexed at %s.', repo, sha)
+        return repo, find_outdated_in_index(index, repo, rules)
+
+    index.load()
+    pool = ThreadPool(workers)
+    try:
+        for repo, paths in pool.imap_unordered(scan, repos):
+            yield repo, paths
+    finally:
+        pool.terminate()
+        index.save()
+
+
+def remote_master_sha(https_uri, owner, repo):
+    """
+    Return the commit the master branch of a remote repo points to, checked with `git ls-remote`, which is much
+    cheaper than a fetch. Return None if it can't be checked.
+    :param https_uri:
+    :param owner:
+    :param repo:
+    :return:
+    """
     try:
-        root = ElementTree.XML(xml)
-    except UnicodeEncodeError as e:
-        logger.warn('Could not parse xml of repo %s.\n%s', repo, e)
+        output = run_cmd(['git', 'ls-remote', '%s/%s/%s' % (https_uri, owner, repo), 'refs/heads/master'],
+                         stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
         return None
+    return output.split()[0] if output.strip() else None
 
-    deps = root.find(target_parent)
-    if deps is None:
+
+def get_master_sha(api_url, repo):
+    """
+    Return the commit the master branch of a repo points to, or None.
+    :param api_url:
+    :param repo:
+    :return:
+    """
+    r = github_client.get_cached('%srepos/%s/branches/master' % (api_url, repo))
+    if r.status_code != requests.codes.ok:
         return None
+    return r.json()['commit']['sha']
 
-    for i in deps.findall(target_children):
-        artifact_id_el = i.find('artifactId')
-        version_string_el = i.find('version')
-        group_id_el = i.find('groupId')
 
-        if artifact_id_el is None or artifact_id_el.text != dependency or version_string_el is None:
-            continue
+class PomIndex(object):
+    """
+    Persistent inverted index of the dependencies and plugins declared in the poms on the master branch of repos.
+    Maps 'groupId:artifactId' to a list of [repo, pom path, groupId, version, XPath of the version element].
+    Each repo is recorded with the commit it was indexed at, so it's only re-indexed once its master branch moves.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # 'owner/repo' -> {'sha': commit, 'poms': [path, ...], 'artifacts': ['groupId:artifactId', ...]}
+        self.repos = {}
+        self.artifacts = {}
+        self.lock = threading.Lock()
 
-        version_string = version_string_el.text
-        if semantic_version.Version(version_string) >= semantic_version.Version(minimum_version):
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('format') != POM_INDEX_FORMAT:
+            logger.info('Pom index %s has an old format. Rebuilding it.', self.path)
+            return
+        self.repos = data['repos']
+        self.artifacts = data['artifacts']
+
+    def save(self):
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        # Write to a temporary file and rename it so a crash never leaves a partial index.
+        tmp_path = '%s.tmp' % self.path
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump({'format': POM_INDEX_FORMAT, 'repos': self.repos, 'artifacts': self.artifacts}, f)
+        os.rename(tmp_path, self.path)
+
+    def indexed_sha(self, repo):
+        """
+        Return the commit repo was last indexed at or None.
+        :param repo:
+        :return:
+        """
+        with self.lock:
+            record = self.repos.get(repo)
+            return record['sha'] if record is not None else None
+
+    def update_repo(self, repo, sha, pom_paths, entries):
+        """
+        Replace everything indexed for repo.
+        :param repo:
+        :param sha: Commit the entries were read at
+        :param pom_paths: Paths of all poms at the commit
+        :param entries: List of (pom path, groupId, artifactId, version, XPath) tuples
+        :return:
+        """
+        with self.lock:
+            for key in self.repos.get(repo, {}).get('artifacts', []):
+                remaining = [e for e in self.artifacts.get(key, []) if e[0] != repo]
+                if remaining:
+                    self.artifacts[key] = remaining
+                else:
+                    self.artifacts.pop(key, None)
+
+            keys = set()
+            for path, group_id, artifact_id, version, xpath in entries:
+                key = '%s:%s' % (group_id, artifact_id)
+                self.artifacts.setdefault(key, []).append([repo, path, group_id, version, xpath])
+                keys.add(key)
+            self.repos[repo] = {'sha': sha, 'poms': pom_paths, 'artifacts': sorted(keys)}
+
+    def find(self, artifact_id, group_id=None):
+        """
+        Return the entries of an artifact in all indexed repos.
+        :param artifact_id:
+        :param group_id: If None, match the artifact ID in any group.
+        :return:
+        """
+        with self.lock:
+            if group_id is not None:
+                return list(self.artifacts.get('%s:%s' % (group_id, artifact_id), []))
+            suffix = ':%s' % artifact_id
+            return [e for key, entries in self.artifacts.items() if key.endswith(suffix) for e in entries]
+
+    def find_outdated(self, artifact_id, minimum_version, group_id=None, repo=None, xpaths=None):
+        """
+        Return the entries of an artifact with a version less than minimum_version. Versions that aren't semantic
+        versions, e.g. unresolved ${property} references, are skipped.
+        :param artifact_id:
+        :param minimum_version:
+        :param group_id:
+        :param repo: Only return entries of this repo.
+        :param xpaths: Only return entries whose version element is at one of these XPaths, ignoring positions.
+        :return:
+        """
+        minimum = semantic_version.Version(minimum_version)
+        outdated = []
+        for entry in self.find(artifact_id, group_id=group_id):
+            entry_repo, _, _, version, entry_xpath = entry
+            if repo is not None and entry_repo != repo:
+                continue
+            if xpaths is not None and re.sub(r'\[\d+\]', '', entry_xpath) not in xpaths:
+                continue
+            try:
+                if semantic_version.Version(version) < minimum:
+                    outdated.append(entry)
+            except ValueError:
+                logger.debug('Skipping version %s of %s in %s that isn\'t a semantic version.',
+                             version, artifact_id, entry_repo)
+        return outdated
+
+
+def index_mirror(index, repo, mirror_path):
+    """
+    Parse every pom.xml on the master branch of a mirror into the index, unless it's already indexed at that commit.
+    A mirror that git fails to read is skipped with a warning.
+    :param index: PomIndex
+    :param repo: Repo in the form of 'owner/repo'
+    :param mirror_path:
+    :return:
+    """
+    try:
+        sha = run_cmd(['git', '--git-dir', mirror_path, 'rev-parse', '--verify', '--quiet',
+                       'refs/heads/master']).strip()
+    except subprocess.CalledProcessError:
+        logger.info('Mirror of %s has no master branch. Not indexing it.', repo)
+        return
+    if index.indexed_sha(repo) == sha:
+        return
+
+    try:
+        tree = run_cmd(['git', '--git-dir', mirror_path, 'ls-tree', '-r', '--name-only', '-z', sha])
+        pom_paths = [p for p in tree.split('\0') if os.path.basename(p) == 'pom.xml']
+        blobs = read_blobs(mirror_path, sha, pom_paths)
+    except subprocess.CalledProcessError as e:
+        logger.warning('Failed to read mirror of %s in %s. Not indexing it.\n%s', repo, mirror_path, e)
+        return
+
+    poms = PomSet(dict(zip(pom_paths, blobs)).get)
+    entries = []
+    for path in pom_paths:
+        pom = poms.get(path)
+        if pom is None:
             continue
+        # Index resolved coordinates so ${property} versions can be compared
+        for group_id, artifact_id, version, xpath in pom.artifacts:
+            entries.append((path, poms.resolve(pom, group_id)[0], artifact_id, poms.resolve(pom, version)[0], xpath))
+
+    index.update_repo(repo, sha, pom_paths, entries)
+    logger.debug('Indexed %d poms of repo %s at %s.', len(pom_paths), repo, sha)
 
-        if group_id is not None and group_id_el is not None and group_id != group_id_el.text:
+
+def read_blobs(git_dir, sha, paths):
+    """
+    Return the contents of files at a commit, read with a single git cat-file process.
+    :param git_dir:
+    :param sha:
+    :param paths:
+    :return: List of strings in the order of paths, None for files that don't exist
+    :raises subprocess.CalledProcessError: If git cat-file fails
+    """
+    if not paths:
+        return []
+    cmd_parts = ['git', '--git-dir', git_dir, 'cat-file', '--batch']
+    p = subprocess.Popen(cmd_parts, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = p.communicate(''.join('%s:%s\n' % (sha, path) for path in paths))
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd_parts, out)
+
+    blobs = []
+    offset = 0
+    for _ in paths:
+        header_end = out.index('\n', offset)
+        if out[offset:header_end].endswith(' missing'):
+            blobs.append(None)
+            offset = header_end + 1
             continue
+        size = int(out[offset:header_end].split()[2])
+        blobs.append(out[header_end + 1:header_end + 1 + size])
+        offset = header_end + 1 + size + 1
+    return blobs
 
-        logger.info('According to the search index, repo %s has %s version %s',
-                    repo, dependency, version_string)
 
-        # We found an outdated dependency
-        return raw_url
+def sync_fork_with_upstream(repo_path, api_url, repo, fork, forks, strategy=CLONE_FULL, mirror_path=None):
+    """
+    Check out the tip of upstream's master branch in a clone of a fork, so the pull request branch starts from it.
+    If the clone borrows objects from an up to date mirror of upstream, the tip is checked out from there without
+    syncing the fork at all. Otherwise the fork's master branch is fast-forwarded on GitHub if it's behind and fetched.
+    Return whether the clone is at upstream's tip.
+    :param repo_path: Path to the clone of the fork
+    :param api_url:
+    :param repo: Upstream repo in the form of 'owner/repo'
+    :param fork: Fork in the form of 'owner/repo'
+    :param forks: ForkManager
+    :param strategy: The CLONE_STRATEGIES value the repo was cloned with
+    :param mirror_path: Mirror of repo the clone borrows objects from
+    :return:
+    """
+    if mirror_path is not None:
+        try:
+            upstream_sha = subprocess.check_output(['git', '--git-dir', mirror_path, 'rev-parse', '--verify',
+                                                    '--quiet', 'refs/heads/master^{commit}']).strip()
+            run_cmd(['git', 'checkout', '-B', 'master', upstream_sha], stderr=subprocess.STDOUT, cwd=repo_path)
+            return True
+        except subprocess.CalledProcessError:
+            logger.debug('Mirror %s has no master branch. Syncing the fork.', mirror_path)
+
+    if forks.sync(api_url, repo, fork) is None:
+        return False
+    fetch_args = []
+    if strategy != CLONE_FULL:
+        fetch_args = ['--depth', '1']
+    if strategy == CLONE_SPARSE:
+        fetch_args.append('--filter=blob:none')
+    run_cmd(['git', 'fetch'] + fetch_args + ['origin', 'master'], stderr=subprocess.STDOUT, retry=True,
+            cwd=repo_path)
+    run_cmd(['git', 'checkout', '-B', 'master', 'FETCH_HEAD'], stderr=subprocess.STDOUT, cwd=repo_path)
+    return True
 
-    # We didn't find an outdated dependency
-    return None
 
+class ForkManager(object):
+    """
+    Keeps forks in step with their upstream repos instead of deleting and forking them again. The upstream commit
+    each fork's master branch was last synced to is cached in a JSON file, so forks that are already at upstream's
+    tip aren't checked again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.synced = {}  # 'owner/repo' of the fork -> upstream commit
+        self.lock = threading.Lock()
+        self.load()
 
-def clone_repo(https_uri, owner, repo, clone_dir, retry=False):
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.synced = json.load(f)
+        except (IOError, ValueError):
+            self.synced = {}
+
+    def save(self):
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        # Write to a temporary file and rename it so a crash never leaves a partial file.
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.synced, f)
+        os.rename(tmp_path, self.path)
+
+    def sync(self, api_url, repo, fork):
+        """
+        Fast-forward the master branch of a fork to upstream's if it's behind, with a single ref update. Forks share
+        objects with their parent, so nothing has to be pushed. A fork that diverged from upstream is reset to it.
+        Return the upstream commit or None if the fork couldn't be synced.
+        :param api_url:
+        :param repo: Upstream repo in the form of 'owner/repo'
+        :param fork: Fork in the form of 'owner/repo'
+        :return:
+        """
+        upstream_sha = get_master_sha(api_url, repo)
+        if upstream_sha is None:
+            return None
+        with self.lock:
+            if self.synced.get(fork) == upstream_sha:
+                return upstream_sha
+
+        if get_master_sha(api_url, fork) != upstream_sha:
+            ref_url = '%srepos/%s/git/refs/heads/master' % (api_url, fork)
+            r = github_request('PATCH', ref_url, data=json.dumps({'sha': upstream_sha}))
+            if r.status_code == requests.codes.ok:
+                logger.info('Fast-forwarded master of %s to %s.', fork, upstream_sha)
+            else:
+                logger.info('Master of %s diverged from upstream. Resetting it to %s.', fork, upstream_sha)
+                r = github_request('PATCH', ref_url, data=json.dumps({'sha': upstream_sha, 'force': True}))
+                if r.status_code != requests.codes.ok:
+                    logger.info('Couldn\'t update master of %s. Got status code %d.', fork, r.status_code)
+                    return None
+
+        with self.lock:
+            self.synced[fork] = upstream_sha
+            self.save()
+        return upstream_sha
+
+
+def clone_repo(https_uri, owner, repo, clone_dir, retry=False, reference=None, strategy=CLONE_FULL, paths=None,
+               patterns=None):
     """
     Clone a repo with retries. Return the path of the cloned repo or None on failure.
     :param https_uri:
@@ -629,20 +2395,123 @@ def clone_repo(https_uri, owner, repo, clone_dir, retry=False):
     :param repo:
     :param clone_dir
     :param retry:
+    :param reference: Optional path of a local mirror to borrow objects from
+    :param strategy: One of CLONE_STRATEGIES
+    :param paths: Paths to check out when strategy is CLONE_SPARSE
+    :param patterns: File name patterns to check out in every directory when strategy is CLONE_SPARSE
     :return:
     """
     repo_uri = '%s/%s/%s' % (https_uri, owner, repo)
     repo_clone_path = os.path.join(clone_dir, repo)
+    reference_args = [] if reference is None else ['--reference', os.path.abspath(reference)]
 
     try:
-        run_cmd(['git', 'clone', repo_uri, repo_clone_path], stderr=subprocess.STDOUT, retry=retry)
+        run_cmd(['git', 'clone'] + reference_args + clone_strategy_args(strategy) + [repo_uri, repo_clone_path],
+                stderr=subprocess.STDOUT, retry=retry)
+        if strategy == CLONE_SPARSE:
+            sparse_checkout(repo_clone_path, paths or [], patterns=patterns)
     except subprocess.CalledProcessError as e:
         logger.info('Failed to clone repo %s into %s.\n%s', repo_uri, repo_clone_path, e)
         return None
     return repo_clone_path
 
 
-def at_mention_recent_committers(base_url, api_url, repo, pr_number, commenting_user, github_token):
+def clone_strategy_args(strategy):
+    """
+    Return the extra `git clone` arguments for a clone strategy.
+    :param strategy: One of CLONE_STRATEGIES
+    :return:
+    """
+    if strategy == CLONE_SHALLOW:
+        return ['--depth', '1']
+    if strategy == CLONE_SPARSE:
+        return ['--depth', '1', '--filter=blob:none', '--no-checkout']
+    return []
+
+
+def sparse_checkout(repo_path, paths, patterns=None):
+    """
+    Check out only the given paths of a clone made with --no-checkout. Blobs of other files are never downloaded.
+    :param repo_path:
+    :param paths: Paths relative to the root of the repo
+    :param patterns: File name patterns like 'pom.xml' that match in every directory. Paths are anchored to the
+                     root of the repo, so they can't be used for this.
+    :return:
+    """
+    run_cmd(['git', 'sparse-checkout', 'set', '--no-cone'] + ['/' + p.lstrip('/') for p in paths] +
+            list(patterns or []), stderr=subprocess.STDOUT, cwd=repo_path)
+    run_cmd(['git', 'checkout'], stderr=subprocess.STDOUT, cwd=repo_path)
+
+
+def update_mirror(https_uri, owner, repo, mirror_dir):
+    """
+    Create or incrementally fetch a bare mirror of a repo in the persistent mirror cache.
+    Return the path of the mirror or None on failure.
+    :param https_uri:
+    :param owner:
+    :param repo:
+    :param mirror_dir: Directory holding all mirrors
+    :return:
+    """
+    repo_uri = '%s/%s/%s' % (https_uri, owner, repo)
+    mirror_path = os.path.join(mirror_dir, '%s_%s.git' % (owner, repo))
+
+    try:
+        if not os.path.isdir(mirror_path):
+            run_cmd(['git', 'init', '--quiet', '--bare', mirror_path], stderr=subprocess.STDOUT)
+        run_cmd(['git', '--git-dir', mirror_path, 'fetch', '--quiet', '--prune', repo_uri] + MIRROR_REFSPECS,
+                stderr=subprocess.STDOUT, retry=True)
+    except subprocess.CalledProcessError as e:
+        logger.info('Failed to update mirror of %s in %s.\n%s', repo_uri, mirror_path, e)
+        return None
+
+    # Mark the mirror as recently used for LRU eviction.
+    os.utime(mirror_path, None)
+    return mirror_path
+
+
+def evict_mirrors(mirror_dir, max_mb):
+    """
+    Delete the least recently used mirrors until the mirror cache takes up at most max_mb megabytes.
+    :param mirror_dir: Directory holding all mirrors
+    :param max_mb: Disk budget in megabytes
+    :return:
+    """
+    if not os.path.isdir(mirror_dir):
+        return
+
+    mirrors = []
+    for name in os.listdir(mirror_dir):
+        path = os.path.join(mirror_dir, name)
+        if os.path.isdir(path):
+            mirrors.append((os.path.getmtime(path), dir_size(path), path))
+
+    total = sum(size for _, size, _ in mirrors)
+    for _, size, path in sorted(mirrors):
+        if total <= max_mb * 1024 * 1024:
+            break
+        logger.info('Evicting mirror %s to keep cache under %d MB.', path, max_mb)
+        remove_dir(path)
+        total -= size
+
+
+def dir_size(path):
+    """
+    Return the total size in bytes of all files under path.
+    :param path:
+    :return:
+    """
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+    return total
+
+
+def at_mention_recent_committers(base_url, api_url, repo, pr_number, commenting_user):
     """
     @Mention recent committers
     :param base_url:
@@ -650,7 +2519,6 @@ def at_mention_recent_committers(base_url, api_url, repo, pr_number, commenting_
     :param repo: owner/repo
     :param pr_number:
     :param commenting_user:
-    :param github_token:
     :return:
     """
     # Do not remind/spam too frequently
@@ -660,7 +2528,7 @@ def at_mention_recent_committers(base_url, api_url, repo, pr_number, commenting_
 
     recent_committers = get_recent_committers(api_url, repo)
     comment = ' '.join(['@' + rc for rc in recent_committers])
-    if not comment_on_issue(api_url, repo, pr_number, comment, github_token):
+    if not comment_on_issue(api_url, repo, pr_number, comment):
         pr_url = '%s%s/pulls/%d' % (base_url, repo, pr_number)
         logger.error('Failed to @mention committers "%s" on PR %s', comment, pr_url)
     else:
@@ -677,7 +2545,7 @@ def get_last_reminder_age(api_url, repo, pr_number, commenting_user):
     :param commenting_user:
     :return: Number of seconds ago
     """
-    r = requests.get('%srepos/%s/issues/%d/comments' % (api_url, repo, pr_number))
+    r = github_client.get_cached('%srepos/%s/issues/%d/comments' % (api_url, repo, pr_number))
     if r.status_code != requests.codes.ok:
         logger.error('Could not get comments from repo "%s" and issue #%d. Returning -1.', repo, pr_number)
         return None
@@ -703,16 +2571,15 @@ def parse_commit_message_file(file_path):
     return commit_msg_title, commit_msg
 
 
-def list_repos(api_url, token):
+def list_repos(api_url):
     """
     Return a list of all the user's repos
     :param api_url:
-    :param token:
     :return: a list of repo names
     """
     repo_names = []
 
-    r = requests.get('%suser/repos' % api_url, auth=HTTPBasicAuth(token, 'x-oauth-basic'))
+    r = github_request('GET', '%suser/repos' % api_url)
     repos = json.loads(r.text)
     logger.info('User has %s repos' % len(repos))
 
@@ -722,37 +2589,35 @@ def list_repos(api_url, token):
     return repo_names
 
 
-def remind_prs(base_url, api_url, pr_branch, username, token):
+def remind_prs(base_url, api_url, pr_branch, username):
     """
     For all this user's open PRs, comment on them with @ mentions as a reminder
     :param base_url:
     :param api_url:
     :param pr_branch:
     :param username:
-    :param token:
     :return:
     """
-    repos = list_repos(api_url, token)
+    repos = list_repos(api_url)
 
     for repo in repos:
-        fork_owner = get_fork_owner(api_url, username, repo, token)
+        fork_owner = get_fork_owner(api_url, username, repo)
         pull_reqs = get_pull_requests(api_url, fork_owner, repo, branch=username + ':' + pr_branch)
         if not isinstance(pull_reqs, list) or len(pull_reqs) < 1:
             continue
         at_mention_recent_committers(base_url, api_url, fork_owner + '/' + repo, pull_reqs[0]['number'],
-                                     username, token)
+                                     username)
 
 
-def get_fork_owner(api_url, fork_owner, repo, token):
+def get_fork_owner(api_url, fork_owner, repo):
     """
     Get the username of the parent repo of the forked repo
     :param api_url:
     :param fork_owner: The username of the user who owns the forked repo
     :param repo:
-    :param token:
     :return: The name of the owner of the parent repo. None if the repo is not a fork.
     """
-    r = requests.get('%srepos/%s/%s' % (api_url, fork_owner, repo), auth=HTTPBasicAuth(token, 'x-oauth-basic'))
+    r = github_client.get_cached('%srepos/%s/%s' % (api_url, fork_owner, repo))
     repo = json.loads(r.text)
     if 'parent' in repo:
         return repo['parent']['owner']['login']
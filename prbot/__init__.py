@@ -5,34 +5,121 @@
 from __future__ import print_function
 
 import argparse
+import base64
 import datetime
+import difflib
+import fnmatch
+import itertools
+import json
 import logging
+import mmap
 import os
+import random
 import re
 import shutil
 import subprocess
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import date
+from multiprocessing.pool import ThreadPool
 
 import sys
+import requests
 from dateutil.relativedelta import relativedelta
 from github import Github
 from github.GithubException import BadCredentialsException
 from github.GithubException import GithubException
 from github.GithubException import UnknownObjectException
+from github.InputGitTreeElement import InputGitTreeElement
 
 DEFAULT_DOMAIN = 'github.com'
 DEFAULT_API_URL = 'https://api.github.com'
 RESULTS_PER_PAGE = 100
 CLONE_DIR = 'repos'
+MIRROR_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'prbot', 'mirrors')
+MIRROR_CACHE_MB = 10 * 1024
+MIRROR_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+CLONE_FULL = 'full'
+CLONE_SHALLOW = 'shallow'  # Only the latest commit
+CLONE_SPARSE = 'sparse'  # Latest commit, only the blobs of the edited files
+CLONE_STRATEGIES = [CLONE_FULL, CLONE_SHALLOW, CLONE_SPARSE]
+EDIT_BACKEND_GIT = 'git'  # Clone, commit and push with git subprocesses
+EDIT_BACKEND_API = 'api'  # Create blobs, trees, commits and refs via the API
+EDIT_BACKENDS = [EDIT_BACKEND_GIT, EDIT_BACKEND_API]
+REGULAR_FILE_MODE = '100644'
+MATCH_LITERAL = 'literal'  # The old string is matched as is
+MATCH_REGEX = 'regex'  # The old string is a regex the new one can refer to
+MATCH_MODES = [MATCH_LITERAL, MATCH_REGEX]
+REWRITE_WORKERS = 8
+REMIND_BACKEND_REST = 'rest'
+REMIND_BACKEND_GRAPHQL = 'graphql'
+REMIND_BACKENDS = [REMIND_BACKEND_REST, REMIND_BACKEND_GRAPHQL]
+GRAPHQL_PAGE_SIZE = 50
+# Open PRs with everything needed to decide whether and whom to remind
+REMINDER_QUERY = '''
+query($query: String!, $cursor: String) {
+  search(query: $query, type: ISSUE, first: %d, after: $cursor) {
+    pageInfo { hasNextPage endCursor }
+    nodes {
+      ... on PullRequest {
+        id
+        url
+        comments(last: 100) { nodes { author { login } createdAt } }
+        baseRepository {
+          defaultBranchRef {
+            target {
+              ... on Commit {
+                history(first: 30) { nodes { committer { user { login } } } }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+''' % GRAPHQL_PAGE_SIZE
+ADD_COMMENT_MUTATION = '''
+mutation($subjectId: ID!, $body: String!) {
+  addComment(input: {subjectId: $subjectId, body: $body}) { clientMutationId }
+}
+'''
+JOURNAL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'prbot',
+                           'journals')
+FORKS_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'prbot',
+                          'forks.json')
+# Stages of a repo in a campaign, in order. STAGE_SEARCHED is recorded once
+# for the whole campaign under the empty repo name.
+STAGE_SEARCHED = 'searched'
+STAGE_DISCOVERED = 'discovered'
+STAGE_FORKED = 'forked'
+STAGE_PUSHED = 'pushed'
+STAGE_PR_CREATED = 'pr_created'
+STAGE_MENTIONED = 'mentioned'
 LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
 DEFAULT_PUSHED_DATE = (date.today() + relativedelta(months=-1))\
     .strftime('%Y-%m-%d')
 MAX_CMD_RETRIES = 10
-CLONE_RETRY_INTERVAL_SEC = 10
+CMD_RETRY_TIMEOUT_SEC = 300
+RETRY_INITIAL_DELAY_SEC = 0.5
+RETRY_MAX_DELAY_SEC = 30
+FORK_READY_TIMEOUT_SEC = 300
 REMINDER_INTERVAL_DAYS = 7
 MAX_GITHUB_RESULTS_PAGE = 10  # Only first 1000 search results are available
+MAX_SEARCH_RESULTS = 1000
+CODE_SEARCH_MAX_FILE_BYTES = 384 * 1024  # Larger files aren't searchable
+SEARCH_SHARD_WORKERS = 4
+# Pause all workers when fewer API requests than this are left in the window
+RATE_LIMIT_MIN_REMAINING = 50
+MAX_RATE_LIMIT_RETRIES = 5
+CORE_BUCKET = 'core'
+SEARCH_BUCKET = 'search'
+GRAPHQL_BUCKET = 'graphql'
+RATE_LIMIT_BUCKETS = (CORE_BUCKET, SEARCH_BUCKET, GRAPHQL_BUCKET)
+SECONDARY_RATE_LIMIT_WAIT_SEC = 60
 
 logger = logging.getLogger(__name__)
 
@@ -68,116 +155,1072 @@ def create_prs(gh, args):
     except IOError as e:
         exit('Specify path to a file containing the commit message.\n%s' % e)
 
+    try:
+        if args.rules:
+            matchers = load_rewrite_rules(args.rules)
+        elif args.old is not None and args.new is not None:
+            matchers = [Matcher(args.old, args.new, args.match_mode)]
+        else:
+            exit('Specify the old and new strings or a --rules file.')
+    except (IOError, ValueError) as e:
+        exit('Could not load rules from %s.\n%s' % (args.rules, e))
+    except re.error as e:
+        exit('Invalid regex.\n%s' % e)
+
+    # Clones are cheap to recreate since their objects come from the mirrors.
     remove_dir(CLONE_DIR)
-
-    logger.info('Searching all code...')
-    qualifiers = {'language': args.language}
-    if not args.no_pushed:
-        qualifiers['pushed'] = args.pushed
+    evict_mirrors(args.mirror_dir, args.mirror_cache_mb)
 
     # noinspection PyUnboundLocalVariable
     pr_branch = branch_name(commit_msg_title)
 
-    content_files = gh.search_code('%s' % args.old, **qualifiers)
-    # TODO find unique repos to which these files belong so we can open one
-    # PR per repo instead of per file?
-    for cf in content_files:
-        logger.debug('Searching %s', cf.repository.full_name)
-        # Github search returns fuzzy results. Check the raw file has exact
-        # string before cloning whole repo.
-        if re.search(r'%s\b' % args.old, cf.decoded_content) is None:
-            continue
+    journal = CampaignJournal(
+        os.path.join(args.journal_dir, '%s.jsonl' % pr_branch))
+    if args.resume:
+        journal.load()
+    elif args.plan is None:
+        journal.clear()
+
+    if journal.done('', STAGE_SEARCHED):
+        logger.info('Resuming campaign %s without searching again.',
+                    pr_branch)
+        repo_paths = OrderedDict()
+        for full_name in journal.repos():
+            paths = journal.get(full_name, STAGE_DISCOVERED)
+            if full_name and paths is not None:
+                repo_paths[full_name] = (gh.get_repo(full_name),
+                                         paths['paths'])
+    else:
+        logger.info('Searching all code...')
+        qualifiers = {'language': args.language}
+        if not args.no_pushed:
+            qualifiers['pushed'] = args.pushed
+
+        content_files = itertools.chain.from_iterable(
+            search_code_sharded(gh, '%s' % matcher.pattern, **qualifiers)
+            for matcher in matchers)
+        repo_paths = group_content_files_by_repo(content_files, matchers)
+        # A plan leaves the journal of the campaign as it is
+        if args.plan is None:
+            for full_name, (_, paths) in repo_paths.items():
+                journal.record(full_name, STAGE_DISCOVERED, paths=paths)
+            journal.record('', STAGE_SEARCHED)
+    logger.info('Found matches in %d repos.', len(repo_paths))
+
+    head = authed_user.login + ':' + pr_branch
+    logger.info('Indexing open PRs from %s...', head)
+    open_pulls = OpenPullIndex(gh, authed_user.login, pr_branch)
+
+    if args.plan is not None:
+        plan = CampaignPlan(args.plan)
+        try:
+            for repo, paths in repo_paths.values():
+                plan_repo_pr(authed_user, repo, paths, pr_branch, matchers,
+                             open_pulls, plan, args)
+        finally:
+            plan.close()
+        logger.info('Wrote plan of campaign %s to %s.', pr_branch, args.plan)
+        return
 
-        head = authed_user.login + ':' + pr_branch
-        repo_pulls = cf.repository.get_pulls(head=head)
-
-        # See if repo already has an open PR with the same branch name
-        # TODO Doing this check here without doing the TODO above might skip
-        # over other files in the other that also have the old string.
-        existing_pull = False
-        for pull in repo_pulls:
-            existing_pull = True
-            logger.info('Already an open PR for %s from %s. See %s. Skipping.',
-                        cf.repository.full_name, head, pull.html_url)
-            break
-        if existing_pull:
+    def create_pr(repo_and_paths):
+        repo, paths = repo_and_paths
+        clone_dir = CLONE_DIR
+        if args.workers > 1:
+            # Give each worker thread its own clone directory.
+            clone_dir = os.path.join(CLONE_DIR,
+                                     threading.current_thread().name)
+        return create_repo_pr(authed_user, repo, paths, head, pr_branch,
+                              commit_msg_title, commit_msg, clone_dir,
+                              matchers, forks, open_pulls, journal, args)
+
+    forks = ForkManager(args.forks_file)
+    if args.workers <= 1:
+        for repo_and_paths in repo_paths.values():
+            create_pr(repo_and_paths)
+        return
+
+    log_buffer = WorkerLogBuffer()
+
+    def create_pr_buffered(repo_and_paths):
+        with log_buffer.capture() as records:
+            try:
+                create_pr(repo_and_paths)
+            except Exception:
+                logger.exception('Failed to create PR for %s.',
+                                 repo_and_paths[0].full_name)
+        return records
+
+    logger.info('Creating PRs with %d workers.', args.workers)
+    logger.addFilter(log_buffer)
+    pool = ThreadPool(args.workers)
+    try:
+        # imap yields in submission order, so each repo's log records are
+        # replayed together and in search result order.
+        for records in pool.imap(create_pr_buffered, repo_paths.values()):
+            for record in records:
+                logger.handle(record)
+    finally:
+        pool.close()
+        pool.join()
+        logger.removeFilter(log_buffer)
+
+
+def create_repo_pr(authed_user, repo, paths, head, pr_branch,
+                   commit_msg_title, commit_msg, clone_dir, matchers, forks,
+                   open_pulls, journal, args):
+    """
+    Fork a single repo, commit the replacements of all rewrite rules with the
+    selected edit backend and open one PR. Return the created PR or
+    None if it was skipped. Stages the journal records as completed are
+    skipped.
+    :param authed_user: github.AuthenticatedUser.AuthenticatedUser
+    :param repo: github.Repository.Repository to open the PR against
+    :param paths: Paths of files in repo that matched the code search
+    :param head: PR head in the form of user:branch
+    :param pr_branch:
+    :param commit_msg_title:
+    :param commit_msg:
+    :param clone_dir: Directory into which to clone
+    :param matchers: List of Matcher, one per rewrite rule
+    :param forks: ForkManager of authed_user's forks
+    :param open_pulls: OpenPullIndex of authed_user's open PRs
+    :param journal: CampaignJournal of the campaign
+    :param args: Parsed command line arguments
+    :return: github.PullRequest.PullRequest
+    """
+    pr_created = journal.get(repo.full_name, STAGE_PR_CREATED)
+    if pr_created is not None:
+        pull = repo.get_pull(pr_created['number'])
+        if args.at_mention_committers \
+                and not journal.done(repo.full_name, STAGE_MENTIONED):
+            at_mention_recent_committers(pull, datetime.datetime.now(),
+                                         authed_user.login)
+            journal.record(repo.full_name, STAGE_MENTIONED)
+        return pull
+
+    # See if repo already has an open PR with the same branch name
+    pull_url = open_pulls.find(repo, pr_branch)
+    if pull_url is not None:
+        logger.info('Already an open PR for %s from %s. See %s. Skipping.',
+                    repo.full_name, head, pull_url)
+        return None
+
+    if journal.done(repo.full_name, STAGE_FORKED):
+        # The fork was checked and ready when it was recorded
+        fork = authed_user.get_repo(repo.name)
+    else:
+        fork = get_or_create_fork(authed_user, repo, args)
+        if fork is None:
+            return None
+        journal.record(repo.full_name, STAGE_FORKED)
+
+    if not journal.done(repo.full_name, STAGE_PUSHED):
+        if args.edit_backend == EDIT_BACKEND_API:
+            edited = commit_edits_with_api(repo, fork, paths, pr_branch,
+                                           commit_msg, matchers)
+        else:
+            edited = commit_edits_with_git(authed_user, repo, fork, paths,
+                                           pr_branch, commit_msg, clone_dir,
+                                           matchers, forks, args)
+        if not edited:
+            return None
+        journal.record(repo.full_name, STAGE_PUSHED, paths=list(edited))
+
+    try:
+        pull = repo.create_pull(
+            pull_request_title(commit_msg_title), commit_msg,
+            repo.default_branch,
+            '%s:%s' % (authed_user.login, pr_branch))
+    except GithubException as e:
+        # For some reason listing PRs and filtering to `head` doesn't work
+        # sometimes. This will then fail because the PR already exists.
+        logger.warn(e)
+        return None
+
+    logger.info('Created PR %s.', pull.html_url)
+    journal.record(repo.full_name, STAGE_PR_CREATED, number=pull.number)
+
+    if args.at_mention_committers:
+        at_mention_recent_committers(pull, datetime.datetime.now(),
+                                     authed_user.login)
+        journal.record(repo.full_name, STAGE_MENTIONED)
+
+    return pull
+
+
+def get_or_create_fork(authed_user, repo, args):
+    """
+    Return authed_user's fork of repo, forking it if there's none yet. Return
+    None if repo is authed_user's own or a new fork wasn't ready in time.
+    :param authed_user: github.AuthenticatedUser.AuthenticatedUser
+    :param repo: github.Repository.Repository to fork
+    :param args: Parsed command line arguments
+    :return: github.Repository.Repository
+    """
+    try:
+        repo_name = repo.name
+        fork = authed_user.get_repo(repo_name)
+        if fork.parent is None:
+            logger.warn('%s has no parent!!' % fork.full_name)
+            raise UnknownObjectException(None, None)
+        if fork.parent.owner.login == authed_user.login:
+            logger.debug('Skipping code search matches on own repo %s',
+                         repo.full_name)
+            return None
+        # Check the parent of the fork is the searched repo to prevent
+        # false matches. This may occur when prbot clones repo A. Then repo
+        # A has its named changed to A' and a new owner creates repo A.
+        if fork.parent.full_name != repo.full_name:
+            raise UnknownObjectException(None, None)
+    except UnknownObjectException:
+        # Fork repo
+        # noinspection PyUnresolvedReferences
+        fork = authed_user.create_fork(repo)
+        # GitHub forks asynchronously. Wait until the fork has refs to clone.
+        if not wait_for_fork(fork.clone_url, authed_user.login,
+                             args.github_token):
+            logger.warning('Fork %s was not ready after %d seconds.',
+                           fork.full_name, FORK_READY_TIMEOUT_SEC)
+            return None
+    return fork
+
+
+def plan_repo_pr(authed_user, repo, paths, pr_branch, matchers, open_pulls,
+                 plan, args):
+    """
+    Add the edits that create_repo_pr would commit to a repo to a campaign
+    plan, without forking, pushing or commenting. With the git edit backend
+    the rewrite rules are applied to every matching file of upstream's
+    default branch in the mirror of the repo, like they would be to the
+    clone. Otherwise they're applied to the paths code search found.
+    :param authed_user: github.AuthenticatedUser.AuthenticatedUser
+    :param repo: github.Repository.Repository to open the PR against
+    :param paths: Paths of files in repo that matched the code search
+    :param pr_branch:
+    :param matchers: List of Matcher, one per rewrite rule
+    :param open_pulls: OpenPullIndex of authed_user's open PRs
+    :param plan: CampaignPlan
+    :param args: Parsed command line arguments
+    :return:
+    """
+    pull_url = open_pulls.find(repo, pr_branch)
+    if pull_url is not None:
+        plan.add_skip(repo.full_name, 'open_pull', pull=pull_url)
+        return
+
+    mirror_path = None
+    if args.edit_backend == EDIT_BACKEND_GIT:
+        mirror_path = update_mirror(repo.clone_url, repo.owner.login,
+                                    repo.name, args.mirror_dir,
+                                    authed_user.login, args.github_token)
+
+    if mirror_path is not None:
+        rev = 'refs/heads/%s' % repo.default_branch
+        file_matchers = OrderedDict()
+        for matcher in matchers:
+            for path in matcher.grep_tree(mirror_path, rev=rev):
+                file_matchers.setdefault(path, []).append(matcher)
+
+        def read(path):
+            return run_cmd(['git', 'cat-file', 'blob', '%s:%s' % (rev, path)],
+                           cwd=mirror_path)
+    else:
+        file_matchers = OrderedDict(
+            (path.lstrip('/'), [m for m in matchers if m.matches_path(path)])
+            for path in paths)
+
+        def read(path):
+            try:
+                return repo.get_contents(path).decoded_content
+            except UnknownObjectException:
+                return None
+
+    edited = False
+    for path, path_matchers in file_matchers.items():
+        text = read(path)
+        if text is None:
             continue
+        new_text, count = text, 0
+        for matcher in path_matchers:
+            new_text, n = matcher.subn(new_text)
+            count += n
+        if count:
+            plan.add_edit(repo.full_name, path, text, new_text, matches=count)
+            edited = True
+    if not edited:
+        plan.add_skip(repo.full_name, 'no_edits')
+
+
+class CampaignPlan(object):
+    """
+    Plan of a campaign written instead of running it. plan.jsonl has a JSON
+    line with the repo, file, action and diff hunks of every file that would
+    be edited, and a line for every repo that would be skipped. plan.diff has
+    the unified diffs of all edits with the repo in the file names.
+    """
+
+    def __init__(self, plan_dir):
+        if not os.path.isdir(plan_dir):
+            os.makedirs(plan_dir)
+        self.plan_file = open(os.path.join(plan_dir, 'plan.jsonl'), 'w')
+        self.diff_file = open(os.path.join(plan_dir, 'plan.diff'), 'w')
+        self.lock = threading.Lock()
+
+    def add_edit(self, repo, path, text, new_text, **data):
+        """
+        Add the edit of a file of a repo to the plan.
+        :param repo: Full name of the repo
+        :param path:
+        :param text: Contents of the file before the edit
+        :param new_text: Contents of the file after the edit
+        :param data: Extra fields of the plan entry
+        :return:
+        """
+        diff = list(difflib.unified_diff(
+            text.splitlines(True), new_text.splitlines(True),
+            'a/%s/%s' % (repo, path), 'b/%s/%s' % (repo, path)))
+        hunks = []
+        for line in diff[2:]:
+            if line.startswith('@@'):
+                hunks.append({'header': line.rstrip('\n'), 'lines': []})
+            else:
+                hunks[-1]['lines'].append(line.rstrip('\n'))
+        entry = dict(data, repo=repo, file=path, action='edit', hunks=hunks)
+        with self.lock:
+            self.plan_file.write(json.dumps(entry) + '\n')
+            self.diff_file.writelines(
+                line if line.endswith('\n')
+                else line + '\n\\ No newline at end of file\n'
+                for line in diff)
+
+    def add_skip(self, repo, reason, **data):
+        """
+        Add a repo that the campaign would skip to the plan.
+        :param repo: Full name of the repo
+        :param reason:
+        :param data: Extra fields of the plan entry
+        :return:
+        """
+        entry = dict(data, repo=repo, file=None, action='skip', reason=reason)
+        with self.lock:
+            self.plan_file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        self.plan_file.close()
+        self.diff_file.close()
+
+
+class CampaignJournal(object):
+    """
+    Append-only JSON lines file recording the stages each repo of a campaign
+    completed, so an interrupted campaign can resume where it stopped. Each
+    line is one completed stage of one repo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = OrderedDict()  # repo -> {stage: data}
+        self.lock = threading.Lock()
+
+    def load(self):
+        line = ''
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line is partial if a run died writing it
+                        continue
+                    self.stages.setdefault(entry['repo'], {})[
+                        entry['stage']] = entry['data']
+        except IOError:
+            return
+        if line and not line.endswith('\n'):
+            # Terminate a partial last line so the next record starts on its
+            # own line
+            with open(self.path, 'a') as f:
+                f.write('\n')
+
+    def clear(self):
+        """
+        Start a new journal.
+        :return:
+        """
+        with self.lock:
+            self.stages.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def record(self, repo, stage, **data):
+        """
+        Durably record that repo completed a stage.
+        :param repo: Full name of the repo
+        :param stage:
+        :param data: JSON serializable details of the stage, e.g. PR number
+        :return:
+        """
+        with self.lock:
+            self.stages.setdefault(repo, {})[stage] = data
+            parent = os.path.dirname(self.path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'repo': repo, 'stage': stage,
+                                    'data': data}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def done(self, repo, stage):
+        with self.lock:
+            return stage in self.stages.get(repo, {})
+
+    def get(self, repo, stage, default=None):
+        with self.lock:
+            return self.stages.get(repo, {}).get(stage, default)
+
+    def repos(self):
+        with self.lock:
+            return list(self.stages.keys())
+
+
+def commit_edits_with_git(authed_user, repo, fork, paths, pr_branch,
+                          commit_msg, clone_dir, matchers, forks, args):
+    """
+    Clone the fork, apply the rewrite rules to every matching file of the
+    working tree, not only the paths code search found, and push one commit
+    to a new branch of the fork. Return the edited file paths, or None if
+    nothing was pushed.
+    :param authed_user: github.AuthenticatedUser.AuthenticatedUser
+    :param repo: github.Repository.Repository to open the PR against
+    :param fork: github.Repository.Repository of authed_user's fork of repo
+    :param paths: Paths of files in repo that matched the code search. Only
+                  these are checked out by the sparse clone strategy.
+    :param pr_branch:
+    :param commit_msg:
+    :param clone_dir: Directory into which to clone
+    :param matchers: List of Matcher, one per rewrite rule
+    :param forks: ForkManager of authed_user's forks
+    :param args: Parsed command line arguments
+    :return:
+    """
+    # Fetch upstream into the persistent mirror so the clone of the fork
+    # only needs to download objects the mirror doesn't have. Shallow clones
+    # download little enough that a full mirror isn't worth it.
+    mirror_path = None
+    if args.clone_strategy == CLONE_FULL:
+        mirror_path = update_mirror(repo.clone_url, repo.owner.login,
+                                    repo.name, args.mirror_dir,
+                                    authed_user.login, args.github_token)
+
+    # Clone forked repo
+    clone_path = clone_repo(fork.clone_url, repo.owner.login,
+                            repo.name, clone_dir,
+                            authed_user.login, args.github_token,
+                            retry=True, reference=mirror_path,
+                            strategy=args.clone_strategy, paths=paths)
+    if clone_path is None:
+        logger.warning('Failed to clone repo %s/%s.'
+                       % (authed_user.login, repo.name))
+        return None
+
+    # Start the PR branch at upstream's tip, since the fork may be behind.
+    # This can happen if upstream repo's name changed after forking.
+    # Then we won't find the authed_user's repo with the new name,
+    # and create_fork() doesn't sync the fork.
+    sync_fork_with_upstream(clone_path, repo, fork, forks,
+                            strategy=args.clone_strategy,
+                            mirror_path=mirror_path)
+
+    counts = rewrite_tree(clone_path, matchers, args.rewrite_workers)
+    edited_paths = [os.path.join(clone_path, path) for path in counts]
+
+    if not edited_paths:
+        logger.debug('Did not find old strings in any files of %s. '
+                     'Skipping.', clone_path)
+        return None
+    logger.info('Replaced %d matches in %d files of %s.',
+                sum(counts.values()), len(edited_paths), repo.full_name)
+
+    # Git commit files and push to Github
+    branch_add_commit_push(edited_paths, pr_branch, commit_msg, clone_path)
+    logger.info('Pushed new branch %s with %d edited files to repo %s.',
+                pr_branch, len(edited_paths), fork.html_url)
+    return edited_paths
 
+
+def commit_edits_with_api(repo, fork, paths, pr_branch, commit_msg,
+                          matchers):
+    """
+    Apply the rewrite rules to all paths and create one commit on top of
+    upstream's default branch, all through the Git Data API without cloning.
+    Point pr_branch of the fork at the commit. Return the edited file paths,
+    or None if nothing was committed.
+    Blobs and trees are created on the fork. Forks share objects with their
+    parent, so the commit can use upstream's tree and commit as its base.
+    :param repo: github.Repository.Repository to open the PR against
+    :param fork: github.Repository.Repository of the fork of repo
+    :param paths: Paths of files in repo that matched the code search
+    :param pr_branch:
+    :param commit_msg:
+    :param matchers: List of Matcher, one per rewrite rule
+    :return:
+    """
+    base_sha = repo.get_branch(repo.default_branch).commit.sha
+    base_commit = repo.get_git_commit(base_sha)
+
+    tree_elements = []
+    edited_paths = []
+    modes = None
+    for path in paths:
+        path = path.lstrip('/')
         try:
-            repo_name = cf.repository.name
-            fork = authed_user.get_repo(repo_name)
-            if fork.parent is None:
-                logger.warn('%s has no parent!!' % fork.full_name)
-                raise UnknownObjectException(None, None)
-            if fork.parent.owner.login == authed_user.login:
-                logger.debug('Skipping code search matches on own repo %s',
-                             cf.repository.full_name)
-                continue
-            # Check the parent of the fork is the ContentFile's repo to prevent
-            # false matches. This may occur when prbot clones repo A. Then repo
-            # A has its named changed to A' and a new owner creates repo A.
-            if fork.parent.full_name != cf.repository.full_name:
-                raise UnknownObjectException(None, None)
+            text = repo.get_contents(path, ref=base_sha).decoded_content
         except UnknownObjectException:
-            # Fork repo
-            # noinspection PyUnresolvedReferences
-            fork = authed_user.create_fork(cf.repository)
-            # Sleep to give GitHub enough time to fork.
-            time.sleep(CLONE_RETRY_INTERVAL_SEC)
-
-        # Clone forked repo
-        clone_path = clone_repo(fork.clone_url, cf.repository.owner.login,
-                                repo_name, CLONE_DIR,
-                                authed_user.login, args.github_token,
-                                retry=True)
-        if clone_path is None:
-            logger.warning('Failed to clone repo %s/%s.'
-                           % (authed_user.login, repo_name))
+            logger.debug('%s no longer exists in %s. Skipping.',
+                         path, repo.full_name)
+            continue
+        new_text, count = text, 0
+        for matcher in matchers:
+            if matcher.matches_path(path):
+                new_text, n = matcher.subn(new_text)
+                count += n
+        if not count:
+            logger.debug('Did not find old strings in %s of %s. Skipping.',
+                         path, repo.full_name)
             continue
+        logger.info('Found %d matches of old strings in %s of %s. Editing',
+                    count, path, repo.full_name)
+
+        blob = fork.create_git_blob(base64.b64encode(new_text), 'base64')
+        if modes is None:
+            modes = tree_entry_modes(repo, base_commit.tree.sha)
+        mode = modes.get(path, REGULAR_FILE_MODE)
+        tree_elements.append(
+            InputGitTreeElement(path, mode, 'blob', sha=blob.sha))
+        edited_paths.append(path)
+
+    if not edited_paths:
+        return None
+
+    tree = fork.create_git_tree(tree_elements, base_tree=base_commit.tree)
+    commit = fork.create_git_commit(commit_msg, tree, [base_commit])
 
-        # Sync in case fork is behind upstream.
-        # This can happen if upstream repo's name changed after forking.
-        # Then we won't find the authed_user's repo with the new name,
-        # and create_fork() doesn't sync the fork.
-        sync_fork_with_upstream(clone_path, cf.repository)
+    # Same as a force push of the branch
+    try:
+        fork.create_git_ref('refs/heads/' + pr_branch, commit.sha)
+    except GithubException:
+        fork.get_git_ref('heads/' + pr_branch).edit(commit.sha, force=True)
 
-        file_path = os.path.join(clone_path, cf.path.lstrip('/'))
+    logger.info('Created commit %s with %d edited files on branch %s of repo '
+                '%s.', commit.sha, len(edited_paths), pr_branch, fork.html_url)
+    return edited_paths
 
-        with open(file_path.decode('ascii')) as f:
-            text = f.read()
 
-        m = re.search(r'%s\b' % args.old, text)
-        if m is None:
-            logger.debug('Did not find old string "%s" in %s. Skipping.',
-                         args.old, file_path)
+def tree_entry_modes(repo, tree_sha):
+    """
+    Return the file modes of all blobs in a git tree by path, e.g. "100755"
+    for executables, from a single recursive tree request.
+    :param repo: github.Repository.Repository
+    :param tree_sha: SHA of the root tree
+    :return: dict of paths relative to the root of the tree to modes
+    """
+    tree = repo.get_git_tree(tree_sha, recursive=True)
+    if tree.raw_data.get('truncated'):
+        logger.warning('Tree %s of %s is too large to list. Files missing from '
+                       'it are committed as regular files.', tree_sha,
+                       repo.full_name)
+    return dict((e.path, e.mode) for e in tree.tree if e.type == 'blob')
+
+
+def search_code_sharded(gh, query, workers=SEARCH_SHARD_WORKERS, **qualifiers):
+    """
+    Search code like gh.search_code, but get past the 1000 results search
+    returns by splitting the search into ranges of file sizes that each match
+    fewer than that. Shards of the same depth are counted in parallel.
+    :param gh: github.Github client
+    :param query:
+    :param workers: Number of shards to count at the same time
+    :param qualifiers: Passed to gh.search_code
+    :return: iterable of github.ContentFile.ContentFile, each file once
+    """
+    def count(size_range):
+        results = gh.search_code(query, size='%d..%d' % size_range,
+                                 **qualifiers)
+        # Fetches the first page, which iterating the results reuses
+        return size_range, results, results.totalCount
+
+    shards = []
+    pool = ThreadPool(workers)
+    try:
+        frontier = [(0, CODE_SEARCH_MAX_FILE_BYTES)]
+        while frontier:
+            next_frontier = []
+            for (lo, hi), results, total in pool.imap_unordered(count,
+                                                                frontier):
+                if total < MAX_SEARCH_RESULTS or lo == hi:
+                    if total >= MAX_SEARCH_RESULTS:
+                        logger.warning('Code search for files of %d bytes '
+                                       'matches %d files. Only the first %d '
+                                       'are searched.',
+                                       lo, total, MAX_SEARCH_RESULTS)
+                    shards.append(results)
+                    continue
+                logger.debug('Code search for files of %d..%d bytes matches '
+                             '%d files. Splitting it.', lo, hi, total)
+                middle = (lo + hi) // 2
+                next_frontier.extend([(lo, middle), (middle + 1, hi)])
+            frontier = next_frontier
+    finally:
+        pool.terminate()
+
+    seen = set()
+    for results in shards:
+        for cf in results:
+            key = (cf.repository.full_name, cf.path)
+            if key not in seen:
+                seen.add(key)
+                yield cf
+
+
+def group_content_files_by_repo(content_files, matchers):
+    """
+    Group code search hits by repository so each repo is forked, cloned and
+    pushed to only once. Github search returns fuzzy results, so hits whose
+    raw file doesn't contain the exact string are dropped before grouping.
+    :param content_files: iterable of github.ContentFile.ContentFile
+    :param matchers: List of Matcher, one per rewrite rule
+    :return: OrderedDict of repo full name -> (github.Repository.Repository,
+             list of file paths), in order of first hit
+    """
+    repo_paths = OrderedDict()
+
+    for cf in content_files:
+        logger.debug('Searching %s in %s', cf.path, cf.repository.full_name)
+        if not any(m.matches_path(cf.path) and m.search(cf.decoded_content)
+                   for m in matchers):
             continue
-        logger.info('Found old string "%s" in %s. Editing',
-                    args.old, file_path)
 
-        new_text = text.replace(args.old, args.new)
-        with open(file_path, 'w') as f:
-            f.write(new_text)
+        full_name = cf.repository.full_name
+        if full_name not in repo_paths:
+            repo_paths[full_name] = (cf.repository, [])
+        if cf.path not in repo_paths[full_name][1]:
+            repo_paths[full_name][1].append(cf.path)
+
+    return repo_paths
+
 
-        # Git commit file and push to Github
-        branch_add_commit_push(file_path, pr_branch, commit_msg, clone_path)
-        logger.info('Pushed new branch %s to repo %s.',
-                    pr_branch, fork.html_url)
+class Matcher(object):
+    """
+    The old string of a rewrite rule compiled once for the whole campaign,
+    with its replacement. In literal mode the old string is matched as is, and
+    must end at a word boundary if it ends with a word character. In regex
+    mode the replacement can refer to groups of the match like re.sub, e.g.
+    \\1. The rule applies to the files that match its glob of paths.
+    """
 
+    def __init__(self, pattern, replacement, mode=MATCH_REGEX, paths=None):
+        self.pattern = pattern
+        self.replacement = replacement
+        self.mode = mode
+        self.paths = paths  # Glob of the paths to rewrite or None for all
+        if mode == MATCH_LITERAL:
+            regex = re.escape(pattern)
+            if re.search(r'\w$', pattern):
+                regex += r'\b'
+        else:
+            regex = pattern
+        self.regex = re.compile(regex)
+
+    def matches_path(self, path):
+        """
+        Return whether the rule applies to a path relative to the repo root.
+        :param path:
+        :return:
+        """
+        return self.paths is None or fnmatch.fnmatch(path.lstrip('/'),
+                                                     self.paths)
+
+    def grep_tree(self, repo_path, rev=None):
+        """
+        Return the paths of the files in the working tree of a repo, or in a
+        commit, that may match, relative to the root of the repo. git grep
+        finds them without opening every file here. Regexes are passed to git
+        as Perl regexes. If git wasn't built with Perl regexes, every file the
+        glob matches is returned.
+        :param repo_path:
+        :param rev: Commit to search instead of the working tree. The repo
+                    can be bare then.
+        :return:
+        """
+        pathspec = [self.paths] if self.paths is not None else []
+        revs = [rev] if rev is not None else []
+        flag = '-F' if self.mode == MATCH_LITERAL else '-P'
         try:
-            pull = cf.repository.create_pull(
-                pull_request_title(commit_msg_title), commit_msg,
-                cf.repository.default_branch,
-                '%s:%s' % (authed_user.login, pr_branch))
-        except GithubException as e:
-            # For some reason listing PRs and filtering to `head` doesn't work
-            # sometimes. This will then fail because the PR already exists.
-            logger.warn(e)
-
-        logger.info('Created PR %s.', pull.html_url)
-
-        if args.at_mention_committers:
-            at_mention_recent_committers(pull, datetime.datetime.now(),
-                                         authed_user.login)
+            output = run_cmd(['git', 'grep', '-l', '-z', '-I', flag,
+                              '-e', self.pattern] + revs + ['--'] + pathspec,
+                             cwd=repo_path)
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 1:  # No matches
+                return []
+            logger.debug('git grep failed in %s. Checking every file.',
+                         repo_path)
+            if rev is None:
+                output = run_cmd(['git', 'ls-files', '-z', '--'] + pathspec,
+                                 cwd=repo_path)
+            else:
+                output = run_cmd(['git', 'ls-tree', '-r', '-z', '--name-only',
+                                  rev], cwd=repo_path)
+                return [path for path in output.split('\0')
+                        if path and self.matches_path(path)]
+        # Matches in a commit are listed as rev:path
+        prefix = '%s:' % rev if rev is not None else ''
+        return [path[len(prefix):] for path in output.split('\0') if path]
+
+    def expand(self, match):
+        """
+        Return the replacement of a match.
+        :param match:
+        :return:
+        """
+        if self.mode == MATCH_LITERAL:
+            return self.replacement
+        return match.expand(self.replacement)
+
+    def search(self, text):
+        """
+        Return whether text contains a match.
+        :param text:
+        :return:
+        """
+        return self.regex.search(text) is not None
+
+    def subn(self, text):
+        """
+        Return text with every match replaced and the number of matches.
+        :param text:
+        :return:
+        """
+        return self.regex.subn(self.expand, text)
+
+    def count_in_file(self, file_path):
+        """
+        Return the number of matches in a file. The file is memory mapped
+        instead of read, so large files aren't loaded into memory at once.
+        :param file_path:
+        :return:
+        """
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return sum(1 for _ in self.regex.finditer(m))
+            finally:
+                m.close()
+
+    def replace_in_file(self, file_path):
+        """
+        Replace every match in a file. Return the number of replaced matches.
+        The file is memory mapped and the result is streamed to a temporary
+        file that replaces it, so large files are never held in memory.
+        :param file_path:
+        :return:
+        """
+        count = self.count_in_file(file_path)
+        if not count:
+            return 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(fd, 'wb') as out, open(file_path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    last = 0
+                    for match in self.regex.finditer(m):
+                        out.write(m[last:match.start()])
+                        out.write(self.expand(match))
+                        last = match.end()
+                    out.write(m[last:])
+                finally:
+                    m.close()
+            shutil.copymode(file_path, tmp_path)
+            os.rename(tmp_path, file_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return count
+
+
+def rewrite_tree(repo_path, matchers, workers=REWRITE_WORKERS):
+    """
+    Apply rewrite rules to every matching file in the working tree of a repo.
+    Files are rewritten in parallel. All rules whose glob matches a file are
+    applied to it in order, each to the output of the rules before it, so a
+    rule can match text that an earlier rule wrote. Log records are emitted
+    from the calling thread, so they stay in its WorkerLogBuffer.
+    :param repo_path:
+    :param matchers: List of Matcher, one per rewrite rule
+    :param workers: Number of files to rewrite at the same time
+    :return: OrderedDict of edited path relative to repo_path -> number of
+             replaced matches
+    """
+    # A file that any rule matches may match later rules after rewriting.
+    file_matchers = OrderedDict()
+    for matcher in matchers:
+        for path in matcher.grep_tree(repo_path):
+            if path not in file_matchers:
+                file_matchers[path] = [m for m in matchers
+                                       if m.matches_path(path)]
+
+    def rewrite(path_and_matchers):
+        path, path_matchers = path_and_matchers
+        file_path = os.path.join(repo_path, path)
+        return path, [(m, m.replace_in_file(file_path))
+                      for m in path_matchers]
+
+    counts = OrderedDict()
+    pool = ThreadPool(workers)
+    try:
+        for path, rule_counts in pool.imap(rewrite, file_matchers.items()):
+            for matcher, count in rule_counts:
+                if count:
+                    logger.info('Found %d matches of old string "%s" in %s. '
+                                'Editing', count, matcher.pattern, path)
+                else:
+                    logger.debug('Did not find old string "%s" in %s.',
+                                 matcher.pattern, path)
+            count = sum(count for _, count in rule_counts)
+            if count:
+                counts[path] = count
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+
+def load_rewrite_rules(path):
+    """
+    Load rewrite rules from a JSON file, either a list of rules or an object
+    with a "rules" list. Each rule has "old" and "new" strings, an optional
+    "mode" that defaults to regex and an optional "paths" glob.
+    :param path:
+    :return: List of Matcher
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    if isinstance(rules, dict):
+        rules = rules.get('rules', [])
+
+    matchers = []
+    for rule in rules:
+        if 'old' not in rule or 'new' not in rule:
+            raise ValueError('Rule %s needs "old" and "new".' % rule)
+        mode = rule.get('mode', MATCH_REGEX)
+        if mode not in MATCH_MODES:
+            raise ValueError('Rule %s has unknown mode "%s".' % (rule, mode))
+        matchers.append(Matcher(rule['old'], rule['new'], mode,
+                                paths=rule.get('paths')))
+    if not matchers:
+        raise ValueError('No rules.')
+    return matchers
+
+
+class OpenPullIndex(object):
+    """
+    Index of a user's open PRs from one head branch keyed by base repo and head
+    branch. It's built with a single paginated issue search instead of listing
+    the PRs of every repo.
+    """
+
+    def __init__(self, gh, login, branch):
+        self.login = login
+        self.pulls = {}
+        issues = gh.search_issues('', state='open', author=login, type='pr',
+                                  head=branch)
+        # Count before iterating. PyGithub treats a count of 0 as unknown and
+        # fetches the next page again, which fails once all were iterated.
+        total = issues.totalCount
+        for issue in issues:
+            self.pulls[(repo_full_name(issue.html_url), branch)] = \
+                issue.html_url
+        # Search only returns the first 1000 results
+        self.complete = len(self.pulls) >= total
+
+    def find(self, repo, branch):
+        """
+        Return the HTML URL of the open PR from branch to repo or None.
+        Fall back to listing the repo's PRs if the index is incomplete.
+        :param repo: github.Repository.Repository
+        :param branch:
+        :return:
+        """
+        url = self.pulls.get((repo.full_name, branch))
+        if url is not None or self.complete:
+            return url
+        for pull in repo.get_pulls(head='%s:%s' % (self.login, branch)):
+            return pull.html_url
+        return None
+
+
+def repo_full_name(html_url):
+    """
+    Return the owner/repo full name from the HTML URL of an issue or PR.
+    E.g. https://github.com/spotify/helios/pull/1 -> spotify/helios.
+    :param html_url:
+    :return:
+    """
+    return '/'.join(html_url.split('/')[-4:-2])
+
+
+class RateLimitGate(object):
+    """
+    Gate every request that a Github client shared by all workers sends.
+    Search, GraphQL and all other (core) requests count against separate rate
+    limits, which are tracked from the X-RateLimit headers of their responses.
+    Callers block while the limit of their request is nearly used up, until
+    its window resets. Requests rejected by a primary or secondary rate limit
+    are sent again after the Retry-After delay or once the limit resets.
+    """
+
+    def __init__(self, api_url, min_remaining=RATE_LIMIT_MIN_REMAINING):
+        self.api_url = api_url.rstrip('/')
+        self.min_remaining = min_remaining
+        self.locks = dict((bucket, threading.Lock())
+                          for bucket in RATE_LIMIT_BUCKETS)
+        # Remaining requests, limit and reset time of each bucket
+        self.limits = dict((bucket, (None, None, 0))
+                           for bucket in RATE_LIMIT_BUCKETS)
+        self.paused_until = dict((bucket, 0) for bucket in RATE_LIMIT_BUCKETS)
+
+    def install(self, gh):
+        """
+        Send all requests of a Github client through this gate.
+        :param gh: github.Github client
+        :return:
+        """
+        # noinspection PyProtectedMember
+        requester = gh._Github__requester
+        for name in ('requestJson', 'requestMultipart'):
+            setattr(requester, name, self.wrap(getattr(requester, name)))
+        gh.rate_limit_gate = self
+
+    def wrap(self, request):
+        def gated_request(verb, url, *args, **kwargs):
+            return self.request(self.bucket(url), request, verb, url,
+                                *args, **kwargs)
+        return gated_request
+
+    def bucket(self, url):
+        if url.startswith(self.api_url):
+            url = url[len(self.api_url):]
+        return SEARCH_BUCKET if url.startswith('/search/') else CORE_BUCKET
+
+    def request(self, bucket, send, *args, **kwargs):
+        """
+        Send a request once the rate limit of its bucket allows it. Send it
+        again if it was rejected by a rate limit.
+        :param bucket: One of RATE_LIMIT_BUCKETS
+        :param send: Function sending the request, which returns its status,
+            headers with lower case names and body
+        :return: What send returns
+        """
+        for retries in range(MAX_RATE_LIMIT_RETRIES):
+            self.wait(bucket)
+            status, headers, body = send(*args, **kwargs)
+            self.update(bucket, headers)
+            delay = rate_limit_retry_delay(status, headers, body)
+            if delay is None or retries == MAX_RATE_LIMIT_RETRIES - 1:
+                return status, headers, body
+            logger.warning('Hit the %s rate limit. Retrying in %d seconds.',
+                           bucket, delay)
+            self.pause(bucket, delay)
+
+    def wait(self, bucket):
+        # Hold the lock while sleeping so every worker pauses together.
+        with self.locks[bucket]:
+            now = time.time()
+            delay = self.paused_until[bucket] - now
+            remaining, limit, reset = self.limits[bucket]
+            # Search allows far fewer requests per window than core.
+            if remaining is not None \
+                    and remaining < min(self.min_remaining, limit // 10 + 1):
+                delay = max(delay, reset - now + 1)
+                logger.warning('Only %d %s API requests left.', remaining,
+                               bucket)
+            if delay <= 0:
+                return
+            logger.warning('Waiting %.1f seconds for the %s rate limit to '
+                           'reset.', delay, bucket)
+            time.sleep(delay)
+            # The next response tells how many requests the new window has.
+            self.limits[bucket] = (None, None, 0)
+
+    def update(self, bucket, headers):
+        try:
+            limits = (int(headers['x-ratelimit-remaining']),
+                      int(headers['x-ratelimit-limit']),
+                      int(headers['x-ratelimit-reset']))
+        except (KeyError, ValueError):
+            return
+        with self.locks[bucket]:
+            self.limits[bucket] = limits
+
+    def pause(self, bucket, seconds):
+        with self.locks[bucket]:
+            self.paused_until[bucket] = max(self.paused_until[bucket],
+                                            time.time() + seconds)
+
+
+def rate_limit_retry_delay(status, headers, body):
+    """
+    Return how many seconds to wait before sending a request again that was
+    rejected by a primary or secondary rate limit, or None if it wasn't.
+    :param status: HTTP status code of the response
+    :param headers: Response headers with lower case names
+    :param body: Response body
+    :return:
+    """
+    if status not in (403, 429):
+        return None
+    if 'retry-after' in headers:
+        try:
+            return max(0, int(headers['retry-after']))
+        except ValueError:
+            return SECONDARY_RATE_LIMIT_WAIT_SEC
+    if headers.get('x-ratelimit-remaining') == '0':
+        # RateLimitGate.wait() sleeps until the limit resets.
+        return 0
+    message = (body or '').lower()
+    if 'rate limit' in message or 'abuse' in message:
+        return SECONDARY_RATE_LIMIT_WAIT_SEC
+    return None
+
+
+class WorkerLogBuffer(logging.Filter):
+    """
+    Hold back log records emitted from inside capture() on the current thread
+    so they can be replayed later by the main thread in a fixed order.
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    @contextmanager
+    def capture(self):
+        self.local.records = []
+        try:
+            yield self.local.records
+        finally:
+            self.local.records = None
 
 
 def remove_dir(dir_name):
@@ -193,34 +1236,38 @@ def remove_dir(dir_name):
         pass
 
 
-def branch_add_commit_push(file_path, new_branch, commit_msg, base_path):
+def branch_add_commit_push(file_paths, new_branch, commit_msg, base_path):
     """
-    Git commit a file. cd to base_path if not None.
-    :param file_path:
+    Git commit files in a single commit in the repo at base_path.
+    :param file_paths: List of paths to files under base_path
     :param new_branch: New git branch name
     :param commit_msg:
     :param base_path:
     :return:
     """
-    with in_dir(base_path):
-        run_cmd(['git', 'checkout', '-b', new_branch],
-                stderr=subprocess.STDOUT)
-        # TODO Seems brittle here; want to remove base part of the file path
-        run_cmd(['git', 'add', file_path.split(base_path + '/')[1]],
-                stderr=subprocess.STDOUT)
-        run_cmd(['git', 'commit', '-m', commit_msg], stderr=subprocess.STDOUT)
-        run_cmd(['git', 'push', '-f', '--set-upstream', 'origin', new_branch],
-                stderr=subprocess.STDOUT)
+    run_cmd(['git', 'checkout', '-b', new_branch],
+            stderr=subprocess.STDOUT, cwd=base_path)
+    # TODO Seems brittle here; want to remove base part of the file path
+    run_cmd(['git', 'add'] +
+            [p.split(base_path + '/')[1] for p in file_paths],
+            stderr=subprocess.STDOUT, cwd=base_path)
+    run_cmd(['git', 'commit', '-m', commit_msg],
+            stderr=subprocess.STDOUT, cwd=base_path)
+    run_cmd(['git', 'push', '-f', '--set-upstream', 'origin', new_branch],
+            stderr=subprocess.STDOUT, retry=True, cwd=base_path)
     return True
 
 
-def run_cmd(cmd_parts, stderr=None, retry=False, log_msg=None):
+def run_cmd(cmd_parts, stderr=None, retry=False, log_msg=None, cwd=None):
     """
     Run a shell command. cmd_parts must be a list of strings.
     :param cmd_parts:
     :param stderr:
-    :param retry:
+    :param retry: Retry failures with jittered exponential backoff. The last
+                  error is raised once retries or the deadline run out.
     :param log_msg: Overriding log message. Good when cmd has sensitive info.
+    :param cwd: Directory to run the command in. Use this instead of changing
+                the process's working directory so workers don't race.
     :return:
     """
     if log_msg is not None:
@@ -228,39 +1275,94 @@ def run_cmd(cmd_parts, stderr=None, retry=False, log_msg=None):
     else:
         logger.debug('%s "%s"', 'Running command', ' '.join(cmd_parts))
 
-    success = False
     retries = 0
-    output = None
+    deadline = time.time() + CMD_RETRY_TIMEOUT_SEC
+    delays = backoff_delays()
 
-    while not success and retries < MAX_CMD_RETRIES:
+    while True:
         try:
-            output = subprocess.check_output(cmd_parts, stderr=stderr)
-            success = True
+            return subprocess.check_output(cmd_parts, stderr=stderr, cwd=cwd)
         except subprocess.CalledProcessError as e:
             if not retry:
                 raise e
-            logger.info('Failed to run command. Retries: %d of %d.',
-                        retries, MAX_CMD_RETRIES)
-            output = e.message
             retries += 1
-            time.sleep(CLONE_RETRY_INTERVAL_SEC)
+            delay = next(delays)
+            if retries >= MAX_CMD_RETRIES or time.time() + delay > deadline:
+                logger.info('Failed to run command. Giving up after %d '
+                            'retries.', retries)
+                raise e
+            logger.info('Failed to run command. Retries: %d of %d. Retrying '
+                        'in %.1f seconds.', retries, MAX_CMD_RETRIES, delay)
+            time.sleep(delay)
 
-    return output
 
+def backoff_delays(initial=RETRY_INITIAL_DELAY_SEC,
+                   maximum=RETRY_MAX_DELAY_SEC):
+    """
+    Yield an endless series of exponentially growing delays in seconds.
+    Each delay is jittered so concurrent retries don't fire in lockstep.
+    :param initial: Upper bound of the first delay
+    :param maximum: Upper bound of any delay
+    :return:
+    """
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2.0, delay)
+        delay = min(delay * 2, maximum)
 
-@contextmanager
-def in_dir(path):
+
+def wait_until(predicate, timeout):
     """
-    Switch to a path, do something, then switch back.
-    :param path:
+    Call predicate with exponential backoff until it returns True or timeout
+    seconds have passed. Return whether predicate returned True.
+    :param predicate: Function taking no arguments
+    :param timeout: Overall deadline in seconds
     :return:
     """
-    saved_path = os.getcwd()
-    try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(saved_path)
+    deadline = time.time() + timeout
+    for delay in backoff_delays():
+        if predicate():
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+
+
+def wait_for_fork(clone_url, login, token, timeout=FORK_READY_TIMEOUT_SEC):
+    """
+    Wait until a newly created fork can be cloned by polling its refs with
+    `git ls-remote`, which is much cheaper than a clone.
+    :param clone_url: URL of the form https://../.git
+    :param login: Username of current user
+    :param token: Corresponding access token of current user
+    :param timeout: Overall deadline in seconds
+    :return: Whether the fork became ready before the deadline
+    """
+    authed_url = authed_clone_url(clone_url, login, token)
+
+    def has_refs():
+        try:
+            output = run_cmd(['git', 'ls-remote', '--heads', authed_url],
+                             stderr=subprocess.STDOUT,
+                             log_msg='Checking refs of %s' % clone_url)
+        except subprocess.CalledProcessError:
+            return False
+        return bool(output.strip())
+
+    return wait_until(has_refs, timeout)
+
+
+def authed_clone_url(clone_url, login, token):
+    """
+    Add credentials to an HTTPS clone URL.
+    :param clone_url: URL of the form https://../.git
+    :param login:
+    :param token:
+    :return:
+    """
+    partial_clone_url = clone_url.split('https://')[1]
+    return 'https://%s:%s@%s' % (login, token, partial_clone_url)
 
 
 def get_recent_committers(repo):
@@ -300,7 +1402,7 @@ def branch_name(string):
 
 
 def clone_repo(clone_url, parent_owner, repo, clone_dir, login, token,
-               retry=False):
+               retry=False, reference=None, strategy=CLONE_FULL, paths=None):
     """
     Clone repo with retries. Return path of the cloned repo or None on failure.
     :param clone_url: URL of the form https://../.git
@@ -311,20 +1413,29 @@ def clone_repo(clone_url, parent_owner, repo, clone_dir, login, token,
     :param login: Username of current user
     :param token: Corresponding access token of current user
     :param retry: Whether to retry
+    :param reference: Optional path of a local mirror to borrow objects from
+    :param strategy: One of CLONE_STRATEGIES
+    :param paths: Paths to check out when strategy is CLONE_SPARSE
     :return:
     """
     repo_clone_path = os.path.join(clone_dir, '%s_%s' % (parent_owner, repo))
 
-    # If it exists, assume it's already cloned
+    # Remove leftovers of an earlier attempt, e.g. of an interrupted run
     if os.path.isdir(repo_clone_path):
-        return
-    partial_clone_url = clone_url.split('https://')[1]
-    authed_clone_url = 'https://%s:%s@%s' % (login, token, partial_clone_url)
+        remove_dir(repo_clone_path)
+    authed_url = authed_clone_url(clone_url, login, token)
+    reference_args = []
+    if reference is not None:
+        reference_args = ['--reference', os.path.abspath(reference)]
 
     try:
-        run_cmd(['git', 'clone', authed_clone_url, repo_clone_path],
+        run_cmd(['git', 'clone'] + reference_args +
+                clone_strategy_args(strategy) +
+                [authed_url, repo_clone_path],
                 stderr=subprocess.STDOUT, retry=retry,
                 log_msg='Cloning %s' % clone_url)
+        if strategy == CLONE_SPARSE:
+            sparse_checkout(repo_clone_path, paths or [])
     except subprocess.CalledProcessError as e:
         logger.info('Failed to clone repo %s into %s.\n%s', clone_url,
                     repo_clone_path, e)
@@ -332,39 +1443,220 @@ def clone_repo(clone_url, parent_owner, repo, clone_dir, login, token,
     return repo_clone_path
 
 
-def sync_fork_with_upstream(repo_path, parent_repo):
+def clone_strategy_args(strategy):
     """
-    Sync the repo's default branch with upstream's default branch
-    :param repo_path: path to clone of the forked repo
-    :param parent_repo: github.Github.Repository
+    Return the extra `git clone` arguments for a clone strategy.
+    :param strategy: One of CLONE_STRATEGIES
     :return:
     """
-    default_branch = parent_repo.default_branch
-    upstream = 'upstream'
+    if strategy == CLONE_SHALLOW:
+        return ['--depth', '1']
+    if strategy == CLONE_SPARSE:
+        return ['--depth', '1', '--filter=blob:none', '--no-checkout']
+    return []
 
-    with in_dir(repo_path):
-        run_cmd(['git', 'checkout', default_branch], stderr=subprocess.STDOUT)
 
-        try:
-            run_cmd(['git', 'remote', 'add', upstream, parent_repo.clone_url],
+def sparse_checkout(repo_path, paths):
+    """
+    Check out only the given paths of a clone made with --no-checkout.
+    Blobs of other files are never downloaded.
+    :param repo_path:
+    :param paths: Paths relative to the root of the repo
+    :return:
+    """
+    run_cmd(['git', 'sparse-checkout', 'set', '--no-cone'] +
+            ['/' + p.lstrip('/') for p in paths],
+            stderr=subprocess.STDOUT, cwd=repo_path)
+    run_cmd(['git', 'checkout'], stderr=subprocess.STDOUT, cwd=repo_path)
+
+
+def update_mirror(clone_url, owner, repo, mirror_dir, login, token):
+    """
+    Create or incrementally fetch a bare mirror of a repo in the persistent
+    mirror cache. Return the path of the mirror or None on failure.
+    The URL with credentials is passed to fetch rather than stored in the
+    mirror's config.
+    :param clone_url: URL of the form https://../.git
+    :param owner: Name of the repo's owner
+    :param repo: Name of repo
+    :param mirror_dir: Directory holding all mirrors
+    :param login: Username of current user
+    :param token: Corresponding access token of current user
+    :return:
+    """
+    mirror_path = os.path.join(mirror_dir, '%s_%s.git' % (owner, repo))
+
+    try:
+        if not os.path.isdir(mirror_path):
+            run_cmd(['git', 'init', '--quiet', '--bare', mirror_path],
                     stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            # Ignore non-zero exit code; we'll assume it's because remote exists
-            pass
+        run_cmd(['git', 'fetch', '--quiet', '--prune',
+                 authed_clone_url(clone_url, login, token)] + MIRROR_REFSPECS,
+                stderr=subprocess.STDOUT, retry=True, cwd=mirror_path,
+                log_msg='Fetching %s into %s' % (clone_url, mirror_path))
+    except subprocess.CalledProcessError as e:
+        logger.info('Failed to update mirror of %s in %s.\n%s', clone_url,
+                    mirror_path, e)
+        return None
+
+    # Mark the mirror as recently used for LRU eviction.
+    os.utime(mirror_path, None)
+    return mirror_path
+
+
+def evict_mirrors(mirror_dir, max_mb):
+    """
+    Delete the least recently used mirrors until the mirror cache takes up at
+    most max_mb megabytes.
+    :param mirror_dir: Directory holding all mirrors
+    :param max_mb: Disk budget in megabytes
+    :return:
+    """
+    if not os.path.isdir(mirror_dir):
+        return
+
+    mirrors = []
+    for name in os.listdir(mirror_dir):
+        path = os.path.join(mirror_dir, name)
+        if os.path.isdir(path):
+            mirrors.append((os.path.getmtime(path), dir_size(path), path))
+
+    total = sum(size for _, size, _ in mirrors)
+    for _, size, path in sorted(mirrors):
+        if total <= max_mb * 1024 * 1024:
+            break
+        logger.info('Evicting mirror %s to keep cache under %d MB.',
+                    path, max_mb)
+        remove_dir(path)
+        total -= size
+
 
-        # Go back in case upstream was force pushed
+def dir_size(path):
+    """
+    Return the total size in bytes of all files under path.
+    :param path:
+    :return:
+    """
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+    return total
+
+
+def sync_fork_with_upstream(repo_path, parent_repo, fork, forks,
+                            strategy=CLONE_FULL, mirror_path=None):
+    """
+    Check out the tip of upstream's default branch in a clone of a fork, so
+    the PR branch starts from it. If the clone borrows objects from an up to
+    date mirror of upstream, the tip is checked out from there without
+    syncing the fork at all. Otherwise the fork's default branch is
+    fast-forwarded on GitHub if it's behind and fetched.
+    :param repo_path: path to clone of the forked repo
+    :param parent_repo: github.Github.Repository
+    :param fork: github.Github.Repository of the fork
+    :param forks: ForkManager
+    :param strategy: The CLONE_STRATEGIES value the repo was cloned with
+    :param mirror_path: Mirror of parent_repo the clone borrows objects from
+    :return:
+    """
+    default_branch = parent_repo.default_branch
+
+    if mirror_path is not None:
         try:
-            run_cmd(['git', 'reset', '--hard', 'HEAD~10'],
-                    stderr=subprocess.STDOUT)
+            upstream_sha = run_cmd(
+                ['git', 'rev-parse', '--verify', '--quiet',
+                 'refs/heads/%s^{commit}' % default_branch],
+                cwd=mirror_path).strip()
+            run_cmd(['git', 'checkout', '-B', default_branch, upstream_sha],
+                    stderr=subprocess.STDOUT, cwd=repo_path)
+            return
         except subprocess.CalledProcessError:
-            # Ignore in case there aren't that many commits
-            pass
+            logger.debug('Mirror %s has no %s branch. Syncing the fork.',
+                         mirror_path, default_branch)
+
+    forks.sync(fork, parent_repo)
+    fetch_args = []
+    if strategy != CLONE_FULL:
+        fetch_args = ['--depth', '1']
+    if strategy == CLONE_SPARSE:
+        fetch_args.append('--filter=blob:none')
+    run_cmd(['git', 'fetch'] + fetch_args + ['origin', default_branch],
+            stderr=subprocess.STDOUT, retry=True, cwd=repo_path)
+    run_cmd(['git', 'checkout', '-B', default_branch, 'FETCH_HEAD'],
+            stderr=subprocess.STDOUT, cwd=repo_path)
+
+
+class ForkManager(object):
+    """
+    Keeps forks in step with their upstream repos instead of deleting and
+    forking them again. The upstream commit each fork's default branch was
+    last synced to is cached in a JSON file, so forks that are already at
+    upstream's tip aren't checked again.
+    """
 
-        run_cmd(['git', 'pull', upstream, default_branch],
-                stderr=subprocess.STDOUT)
+    def __init__(self, path):
+        self.path = path
+        self.synced = {}  # fork full name -> upstream commit SHA
+        self.lock = threading.Lock()
+        self.load()
 
-        run_cmd(['git', 'push', '-f', 'origin', default_branch],
-                stderr=subprocess.STDOUT)
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.synced = json.load(f)
+        except (IOError, ValueError):
+            self.synced = {}
+
+    def save(self):
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        # Write to a temporary file and rename it so a crash never leaves a
+        # partial file.
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.synced, f)
+        os.rename(tmp_path, self.path)
+
+    def sync(self, fork, parent_repo):
+        """
+        Fast-forward the default branch of a fork to upstream's if it's
+        behind, with a single ref update. Forks share objects with their
+        parent, so nothing has to be pushed. A fork that diverged from
+        upstream is reset to it. Return the upstream commit.
+        :param fork: github.Repository.Repository of the fork
+        :param parent_repo: github.Repository.Repository of upstream
+        :return:
+        """
+        default_branch = parent_repo.default_branch
+        upstream_sha = parent_repo.get_branch(default_branch).commit.sha
+        with self.lock:
+            if self.synced.get(fork.full_name) == upstream_sha:
+                return upstream_sha
+
+        fork_ref = fork.get_git_ref('heads/' + default_branch)
+        if fork_ref.object.sha != upstream_sha:
+            try:
+                fork_ref.edit(upstream_sha)
+                logger.info('Fast-forwarded %s of %s to %s.',
+                            default_branch, fork.full_name, upstream_sha)
+            except GithubException:
+                logger.info('%s of %s diverged from upstream. Resetting it '
+                            'to %s.', default_branch, fork.full_name,
+                            upstream_sha)
+                fork_ref.edit(upstream_sha, force=True)
+
+        with self.lock:
+            self.synced[fork.full_name] = upstream_sha
+            self.save()
+        return upstream_sha
 
 
 def at_mention_recent_committers(pull, now, commenting_user):
@@ -429,6 +1721,14 @@ def remind_open_pulls(gh, args):
     :return:
     """
     user = gh.get_user()
+
+    if args.backend == REMIND_BACKEND_GRAPHQL:
+        client = GraphQLClient(graphql_url(args.api_url), args.github_token,
+                               getattr(gh, 'rate_limit_gate', None))
+        remind_open_pulls_graphql(client, user.login,
+                                  datetime.datetime.utcnow())
+        return
+
     issues = gh.search_issues('', state='open', author=user.login, type='pr')
     now = datetime.datetime.now()
 
@@ -437,6 +1737,116 @@ def remind_open_pulls(gh, args):
         at_mention_recent_committers(pull, now, user.login)
 
 
+class GraphQLClient(object):
+    """
+    Minimal client for the GitHub GraphQL API over a keep-alive session.
+    """
+
+    def __init__(self, url, token, rate_limit_gate=None):
+        self.url = url
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'bearer %s' % token
+        self.rate_limit_gate = rate_limit_gate
+
+    def post(self, payload):
+        r = self.session.post(self.url, json=payload)
+        return r.status_code, r.headers, r.text
+
+    def query(self, query, variables=None):
+        """
+        Run a query or mutation and return its data.
+        Raise GithubException if GitHub returns errors.
+        :param query:
+        :param variables:
+        :return: dict
+        """
+        payload = {'query': query, 'variables': variables or {}}
+        if self.rate_limit_gate is None:
+            status, _, text = self.post(payload)
+        else:
+            status, _, text = self.rate_limit_gate.request(
+                GRAPHQL_BUCKET, self.post, payload)
+        try:
+            body = json.loads(text)
+        except ValueError:
+            raise GithubException(status, text)
+        if status != requests.codes.ok or body.get('errors'):
+            raise GithubException(status, body)
+        return body['data']
+
+
+def graphql_url(api_url):
+    """
+    Return the GraphQL endpoint of a GitHub or GitHub Enterprise API URL.
+    E.g. https://api.github.com -> https://api.github.com/graphql and
+    https://ghe.example.com/api/v3 -> https://ghe.example.com/api/graphql.
+    :param api_url:
+    :return:
+    """
+    api_url = api_url.rstrip('/')
+    if api_url.endswith('/v3'):
+        api_url = api_url[:-len('/v3')]
+    return api_url + '/graphql'
+
+
+def remind_open_pulls_graphql(client, login, now):
+    """
+    Same as remind_open_pulls, but fetch the comments and recent committers of
+    GRAPHQL_PAGE_SIZE PRs at a time in one GraphQL query. Only PRs that are
+    due for a reminder cost another request, to post the comment.
+    :param client: GraphQLClient
+    :param login: Login of the user whose PRs to remind about
+    :param now: datetime.datetime in UTC
+    :return:
+    """
+    variables = {'query': 'is:pr is:open author:%s' % login, 'cursor': None}
+
+    while True:
+        search = client.query(REMINDER_QUERY, variables)['search']
+        for pull in search['nodes']:
+            if pull:
+                at_mention_recent_committers_graphql(client, pull, now, login)
+        if not search['pageInfo']['hasNextPage']:
+            break
+        variables['cursor'] = search['pageInfo']['endCursor']
+
+
+def at_mention_recent_committers_graphql(client, pull, now, commenting_user):
+    """
+    @Mention recent committers of a PR returned by REMINDER_QUERY
+    :param client: GraphQLClient
+    :param pull: PullRequest node as a dict
+    :param now: datetime.datetime in UTC
+    :param commenting_user:
+    :return:
+    """
+    last_reminder_datetime = None
+    for comment in reversed(pull['comments']['nodes']):
+        if comment['author'] and comment['author']['login'] == commenting_user:
+            last_reminder_datetime = datetime.datetime.strptime(
+                comment['createdAt'], '%Y-%m-%dT%H:%M:%SZ')
+            break
+    if last_reminder_datetime is not None \
+            and (now - last_reminder_datetime).days < REMINDER_INTERVAL_DAYS:
+        logger.debug('Last @ mention reminder for PR %s was less than a week '
+                     'ago.', pull['url'])
+        return
+
+    recent_committers = set()
+    branch = (pull['baseRepository'] or {}).get('defaultBranchRef') or {}
+    history = (branch.get('target') or {}).get('history') or {'nodes': []}
+    for commit in history['nodes']:
+        if commit['committer'] and commit['committer']['user']:
+            recent_committers.add(commit['committer']['user']['login'])
+
+    comment = 'Please review. ' \
+              + ' '.join(['@' + rc for rc in recent_committers])
+    client.query(ADD_COMMENT_MUTATION, {'subjectId': pull['id'],
+                                        'body': comment})
+    logger.info('@ mentioned recent committers: "%s" on PR %s.',
+                comment, pull['url'])
+
+
 def html_url_to_raw_url(base_url, html_url):
     """
     Return a URL to the raw file on the master branch from Github given an HTML
@@ -493,8 +1903,13 @@ def main(argv):
     # we use subcmd.set_defaults(func=foo) to set a function to run when
     # that command is chosen.
 
-    add_command(pulls_cmd, 'remind', remind_open_pulls,
-                help='@-mention committers on open PRs')
+    remind_cmd = add_command(pulls_cmd, 'remind', remind_open_pulls,
+                             help='@-mention committers on open PRs')
+    remind_cmd.add_argument(
+        '--backend', choices=REMIND_BACKENDS, default=REMIND_BACKEND_REST,
+        help='"graphql" fetches comments and recent committers of %d PRs per '
+             'request instead of several REST requests per PR. '
+             'Defaults to "%s".' % (GRAPHQL_PAGE_SIZE, REMIND_BACKEND_REST))
 
     create_cmd = add_command(pulls_cmd, 'create', create_prs, help='Create PRs')
     create_cmd.add_argument(
@@ -516,9 +1931,68 @@ def main(argv):
         '--at-mention-committers', action='store_true',
         help='@ mention recent committers.')
     create_cmd.add_argument(
-        'old', help='Old string to replace. Can be regex expression.')
+        '--workers', type=int, default=1,
+        help='Number of repos to fork, clone, edit and push concurrently. '
+             'Defaults to 1.')
+    create_cmd.add_argument(
+        '--mirror-dir', default=MIRROR_DIR,
+        help='Directory of persistent bare mirrors that clones borrow objects '
+             'from. Defaults to %s.' % MIRROR_DIR)
+    create_cmd.add_argument(
+        '--mirror-cache-mb', type=int, default=MIRROR_CACHE_MB,
+        help='Disk budget of the mirror directory in megabytes. Least '
+             'recently used mirrors are evicted beyond it. Defaults to %d.'
+             % MIRROR_CACHE_MB)
+    create_cmd.add_argument(
+        '--edit-backend', choices=EDIT_BACKENDS, default=EDIT_BACKEND_GIT,
+        help='"git" clones each fork and pushes with git. "api" commits the '
+             'edits through the GitHub Git Data API without cloning. '
+             'Defaults to "%s".' % EDIT_BACKEND_GIT)
+    create_cmd.add_argument(
+        '--clone-strategy', choices=CLONE_STRATEGIES, default=CLONE_FULL,
+        help='"shallow" clones only the latest commit. "sparse" also checks '
+             'out and downloads only the files being edited. '
+             'Defaults to "%s".' % CLONE_FULL)
+    create_cmd.add_argument(
+        '--resume', action='store_true',
+        help='Resume the last campaign with the same commit message title '
+             'where it stopped. The code search isn\'t run again, and each '
+             'repo continues from the last stage it completed.')
+    create_cmd.add_argument(
+        '--forks-file', default=FORKS_PATH,
+        help='File caching the upstream commit each fork was last synced to. '
+             'Defaults to %s.' % FORKS_PATH)
+    create_cmd.add_argument(
+        '--journal-dir', default=JOURNAL_DIR,
+        help='Directory of the journals that record the progress of each '
+             'campaign. Defaults to %s.' % JOURNAL_DIR)
+    create_cmd.add_argument(
+        '--match-mode', choices=MATCH_MODES, default=MATCH_REGEX,
+        help='"regex" matches the old string as a regex, and the new string '
+             'can refer to its groups like \\1. "literal" matches the old '
+             'string as is. Defaults to "%s".' % MATCH_REGEX)
+    create_cmd.add_argument(
+        '--plan', metavar='PLAN_DIR',
+        help='Only plan the campaign. Code is searched and edited in memory, '
+             'but nothing is forked, pushed or commented on. The plan is '
+             'written to plan.jsonl and the diffs of the edits to plan.diff '
+             'in this directory.')
+    create_cmd.add_argument(
+        '--rules',
+        help='JSON file of rewrite rules to apply instead of old and new. '
+             'Each rule has "old" and "new" strings and optional "mode" and '
+             '"paths" glob, e.g. [{"old": "foo-(\\\\d+)", "new": "bar-\\\\1", '
+             '"paths": "*.xml"}].')
+    create_cmd.add_argument(
+        '--rewrite-workers', type=int, default=REWRITE_WORKERS,
+        help='Number of files of a clone to rewrite concurrently. '
+             'Defaults to %d.' % REWRITE_WORKERS)
+    create_cmd.add_argument(
+        'old', nargs='?',
+        help='Old string to replace. Can be regex expression.')
     create_cmd.add_argument(
-        'new', help='Replacement string.')
+        'new', nargs='?',
+        help='Replacement string. Can refer to groups of old.')
     create_cmd.add_argument(
         'commit_message_file',
         help='Path to file containing Git commit message.')
@@ -531,6 +2005,7 @@ def main(argv):
         setup_logging(logging.DEBUG)
 
     gh = Github(args.github_token, base_url=args.api_url)
+    RateLimitGate(args.api_url).install(gh)
     authed_user = gh.get_user()
     try:
         authed_user.login
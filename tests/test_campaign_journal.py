@@ -0,0 +1,183 @@
+import argparse
+
+import pytest
+
+import prbot
+from prbot import CampaignJournal
+from prbot import STAGE_FORKED
+from prbot import STAGE_MENTIONED
+from prbot import STAGE_PR_CREATED
+from prbot import STAGE_PUSHED
+
+
+class Fake(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeUser(object):
+    login = 'bot'
+
+    def __init__(self, calls, fork):
+        self.calls = calls
+        self.fork = fork
+
+    def get_repo(self, name):
+        self.calls.append('get_repo')
+        return self.fork
+
+    def create_fork(self, repo):
+        self.calls.append('create_fork')
+        return self.fork
+
+
+class FakeRepo(object):
+    full_name = 'owner/repo'
+    name = 'repo'
+    default_branch = 'master'
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_pull(self, number):
+        self.calls.append('get_pull')
+        return Fake(number=number, html_url='https://github.com/pull/%d'
+                                            % number)
+
+    def create_pull(self, title, body, base, head):
+        self.calls.append('create_pull')
+        return Fake(number=7, html_url='https://github.com/pull/7')
+
+
+@pytest.fixture
+def journal(tmpdir):
+    return CampaignJournal(str(tmpdir.join('campaign', 'journal.jsonl')))
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def commit_edits_with_api(repo, fork, paths, *args):
+        calls.append('commit')
+        return paths
+
+    def at_mention_recent_committers(pull, now, login):
+        calls.append('mention')
+
+    def wait_for_fork(clone_url, login, token):
+        calls.append('wait_for_fork')
+        return True
+
+    monkeypatch.setattr(prbot, 'commit_edits_with_api', commit_edits_with_api)
+    monkeypatch.setattr(prbot, 'at_mention_recent_committers',
+                        at_mention_recent_committers)
+    monkeypatch.setattr(prbot, 'wait_for_fork', wait_for_fork)
+    return calls
+
+
+def create_repo_pr(journal, calls, forked=True):
+    parent = None
+    if forked:
+        parent = Fake(full_name='owner/repo', owner=Fake(login='owner'))
+    fork = Fake(full_name='bot/repo', parent=parent,
+                clone_url='https://github.com/bot/repo.git',
+                html_url='https://github.com/bot/repo')
+    args = argparse.Namespace(at_mention_committers=True,
+                              edit_backend=prbot.EDIT_BACKEND_API,
+                              github_token='token')
+    open_pulls = Fake(find=lambda repo, branch: None)
+    return prbot.create_repo_pr(
+        FakeUser(calls, fork), FakeRepo(calls), ['pom.xml'], 'bot:bump',
+        'bump', 'Title', 'Title\n\nBody', None, [], None, open_pulls,
+        journal, args)
+
+
+def test_record_and_load(journal):
+    journal.record('owner/repo', STAGE_FORKED)
+    journal.record('owner/repo', STAGE_PUSHED, paths=['pom.xml'])
+
+    loaded = CampaignJournal(journal.path)
+    loaded.load()
+
+    assert loaded.repos() == ['owner/repo']
+    assert loaded.done('owner/repo', STAGE_FORKED)
+    assert loaded.get('owner/repo', STAGE_PUSHED) == {'paths': ['pom.xml']}
+    assert not loaded.done('owner/repo', STAGE_PR_CREATED)
+
+
+def test_load_skips_partial_last_line(journal):
+    journal.record('owner/repo', STAGE_FORKED)
+    with open(journal.path, 'a') as f:
+        f.write('{"repo": "owner/repo", "sta')
+
+    loaded = CampaignJournal(journal.path)
+    loaded.load()
+    loaded.record('owner/repo', STAGE_PUSHED, paths=[])
+
+    reloaded = CampaignJournal(journal.path)
+    reloaded.load()
+    assert reloaded.done('owner/repo', STAGE_FORKED)
+    assert reloaded.done('owner/repo', STAGE_PUSHED)
+
+
+def test_clear(journal):
+    journal.record('owner/repo', STAGE_FORKED)
+
+    journal.clear()
+    journal.load()
+
+    assert journal.repos() == []
+
+
+def test_create_repo_pr_records_every_stage(journal, calls):
+    pull = create_repo_pr(journal, calls)
+
+    assert pull.number == 7
+    assert calls == ['get_repo', 'commit', 'create_pull', 'mention']
+    assert journal.get('owner/repo', STAGE_PR_CREATED) == {'number': 7}
+    assert journal.done('owner/repo', STAGE_MENTIONED)
+
+
+def test_create_repo_pr_forks(journal, calls):
+    create_repo_pr(journal, calls, forked=False)
+
+    assert calls == ['get_repo', 'create_fork', 'wait_for_fork', 'commit',
+                     'create_pull', 'mention']
+    assert journal.done('owner/repo', STAGE_FORKED)
+
+
+def test_resume_after_forked(journal, calls):
+    journal.record('owner/repo', STAGE_FORKED)
+
+    # The recorded fork is used without checking its parent or forking again
+    create_repo_pr(journal, calls, forked=False)
+
+    assert calls == ['get_repo', 'commit', 'create_pull', 'mention']
+
+
+def test_resume_after_pushed(journal, calls):
+    journal.record('owner/repo', STAGE_FORKED)
+    journal.record('owner/repo', STAGE_PUSHED, paths=['pom.xml'])
+
+    create_repo_pr(journal, calls)
+
+    assert calls == ['get_repo', 'create_pull', 'mention']
+
+
+def test_resume_after_pr_created(journal, calls):
+    journal.record('owner/repo', STAGE_PR_CREATED, number=3)
+
+    pull = create_repo_pr(journal, calls)
+
+    assert pull.number == 3
+    assert calls == ['get_pull', 'mention']
+
+
+def test_resume_after_mentioned(journal, calls):
+    journal.record('owner/repo', STAGE_PR_CREATED, number=3)
+    journal.record('owner/repo', STAGE_MENTIONED)
+
+    create_repo_pr(journal, calls)
+
+    assert calls == ['get_pull']
@@ -0,0 +1,55 @@
+from prbot import MATCH_LITERAL
+from prbot import Matcher
+
+
+def test_literal_match_ends_at_word_boundary():
+    matcher = Matcher('helios-1.0', 'helios-2.0', MATCH_LITERAL)
+
+    assert matcher.subn('helios-1.0 helios-1.01 helios-1.0.') == \
+        ('helios-2.0 helios-1.01 helios-2.0.', 2)
+
+
+def test_literal_match_escapes_regex():
+    matcher = Matcher('a.b(', 'c', MATCH_LITERAL)
+
+    assert matcher.search('xa.b(')
+    assert not matcher.search('axb(')
+
+
+def test_regex_replacement_refers_to_groups():
+    matcher = Matcher(r'foo-(\d+)', r'bar-\1')
+
+    assert matcher.subn('foo-1 foo-22 foo-') == ('bar-1 bar-22 foo-', 2)
+
+
+def test_matches_path():
+    matcher = Matcher('foo', 'bar', paths='*.xml')
+
+    assert matcher.matches_path('pom.xml')
+    assert matcher.matches_path('/module/pom.xml')
+    assert not matcher.matches_path('README.md')
+    assert Matcher('foo', 'bar').matches_path('README.md')
+
+
+def test_count_in_file(tmpdir):
+    path = tmpdir.join('file.txt')
+    path.write('foo-1 foo-2\nfoo-3')
+    empty = tmpdir.join('empty.txt')
+    empty.write('')
+    matcher = Matcher(r'foo-\d', 'bar')
+
+    assert matcher.count_in_file(str(path)) == 3
+    assert matcher.count_in_file(str(empty)) == 0
+
+
+def test_replace_in_file(tmpdir):
+    path = tmpdir.join('run.sh')
+    path.write('foo-1 foo-2\nbaz')
+    path.chmod(0o755)
+    matcher = Matcher(r'foo-(\d)', r'bar-\1')
+
+    assert matcher.replace_in_file(str(path)) == 2
+    assert path.read() == 'bar-1 bar-2\nbaz'
+    assert path.stat().mode & 0o777 == 0o755
+    assert matcher.replace_in_file(str(path)) == 0
+    assert tmpdir.listdir() == [path]
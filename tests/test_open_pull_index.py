@@ -0,0 +1,37 @@
+from github import Github
+
+from prbot import OpenPullIndex
+
+
+def search_results(items):
+    gh = Github('token')
+    requests = []
+
+    def request_json_and_check(verb, url, parameters=None, headers=None,
+                               input=None):
+        requests.append(url)
+        return {}, {'total_count': len(items), 'items': items}
+
+    # noinspection PyUnresolvedReferences
+    gh._Github__requester.requestJsonAndCheck = request_json_and_check
+    return gh, requests
+
+
+def test_no_open_pulls():
+    gh, requests = search_results([])
+
+    index = OpenPullIndex(gh, 'bot', 'bump-foo')
+
+    assert index.pulls == {}
+    assert index.complete
+    assert len(requests) == 1
+
+
+def test_open_pulls():
+    url = 'https://github.com/owner/repo/pull/1'
+    gh, _ = search_results([{'html_url': url, 'number': 1}])
+
+    index = OpenPullIndex(gh, 'bot', 'bump-foo')
+
+    assert index.pulls == {('owner/repo', 'bump-foo'): url}
+    assert index.complete
@@ -0,0 +1,168 @@
+import imp
+import os
+
+prbot_script = imp.load_source(
+    'prbot_script',
+    os.path.join(os.path.dirname(__file__), os.pardir, 'prbot.py'))
+
+NAMESPACED_POM = '''<?xml version="1.0" encoding="UTF-8"?>
+<project xmlns="http://maven.apache.org/POM/4.0.0"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <modelVersion>4.0.0</modelVersion>
+  <groupId>com.example</groupId>
+  <artifactId>app</artifactId>
+  <version>1.0.0</version>
+  <dependencies>
+    <dependency>
+      <groupId>com.spotify</groupId>
+      <artifactId>helios-testing</artifactId>
+      <version> 0.8.100 </version>
+    </dependency>
+    <dependency>
+      <groupId>junit</groupId>
+      <artifactId>junit</artifactId>
+      <version>4.12.0</version>
+    </dependency>
+  </dependencies>
+</project>
+'''
+
+UNNAMESPACED_POM = '''<project>
+  <groupId>com.example</groupId>
+  <artifactId>app</artifactId>
+  <version>1.0.0</version>
+  <build>
+    <plugins>
+      <plugin>
+        <artifactId>maven-surefire-plugin</artifactId>
+        <version>2.19</version>
+      </plugin>
+    </plugins>
+  </build>
+</project>
+'''
+
+PARENT_POM = '''<project xmlns="http://maven.apache.org/POM/4.0.0">
+  <groupId>com.example</groupId>
+  <artifactId>parent</artifactId>
+  <version>1.0.0</version>
+  <properties>
+    <helios.version>0.8.100</helios.version>
+    <junit.version>4.12</junit.version>
+  </properties>
+</project>
+'''
+
+CHILD_POM = '''<project xmlns="http://maven.apache.org/POM/4.0.0">
+  <parent>
+    <groupId>com.example</groupId>
+    <artifactId>parent</artifactId>
+    <version>1.0.0</version>
+  </parent>
+  <artifactId>child</artifactId>
+  <dependencies>
+    <dependency>
+      <groupId>com.spotify</groupId>
+      <artifactId>helios-testing</artifactId>
+      <version>${helios.version}</version>
+    </dependency>
+  </dependencies>
+</project>
+'''
+
+HELIOS_XPATH = '/project/dependencies[1]/dependency[1]/version'
+
+
+def pom_set(files):
+    return prbot_script.PomSet(files.get)
+
+
+def test_namespaced_pom():
+    pom = prbot_script.Pom('pom.xml', NAMESPACED_POM)
+
+    assert (pom.group_id, pom.artifact_id, pom.version) == \
+        ('com.example', 'app', '1.0.0')
+    assert pom.artifacts == [
+        ('com.spotify', 'helios-testing', '0.8.100', HELIOS_XPATH),
+        ('junit', 'junit', '4.12.0',
+         '/project/dependencies[1]/dependency[2]/version'),
+    ]
+    start, end = pom.spans[HELIOS_XPATH]
+    assert pom.text[start:end] == '0.8.100'
+
+
+def test_unnamespaced_pom():
+    pom = prbot_script.Pom('pom.xml', UNNAMESPACED_POM)
+
+    xpath = '/project/build[1]/plugins[1]/plugin[1]/version'
+    assert pom.artifacts == [(prbot_script.DEFAULT_PLUGIN_GROUP_ID,
+                              'maven-surefire-plugin', '2.19', xpath)]
+    start, end = pom.spans[xpath]
+    assert pom.text[start:end] == '2.19'
+
+
+def test_resolve_property_of_parent():
+    poms = pom_set({'pom.xml': PARENT_POM, 'child/pom.xml': CHILD_POM})
+    child = poms.get('child/pom.xml')
+
+    resolved, (defining_pom, name) = poms.resolve(child, '${helios.version}')
+
+    assert resolved == '0.8.100'
+    assert defining_pom.path == 'pom.xml'
+    assert name == 'helios.version'
+
+
+def test_resolve_builtin_and_unknown_properties():
+    poms = pom_set({'pom.xml': PARENT_POM, 'child/pom.xml': CHILD_POM})
+    child = poms.get('child/pom.xml')
+
+    assert poms.resolve(child, '${project.version}') == ('1.0.0', None)
+    assert poms.resolve(child, '${missing}') == ('${missing}', None)
+
+
+def test_find_pom_edits_edits_property_of_parent():
+    poms = pom_set({'pom.xml': PARENT_POM, 'child/pom.xml': CHILD_POM})
+    rules = [prbot_script.DependencyRule('helios-testing', '0.8.380')]
+
+    edits = prbot_script.find_pom_edits(poms, ['child/pom.xml'], rules)
+
+    assert [(e.path, e.element, e.old, e.new) for e in edits] == \
+        [('pom.xml', 'helios.version', '0.8.100', '0.8.380')]
+
+
+def test_patch_pom():
+    poms = pom_set({'pom.xml': NAMESPACED_POM})
+    rules = [prbot_script.DependencyRule('helios-testing', '0.8.380'),
+             prbot_script.DependencyRule('junit', '4.12.0')]
+    pom = poms.get('pom.xml')
+    edits = prbot_script.find_pom_edits(poms, ['pom.xml'], rules)
+
+    text, applied = prbot_script.patch_pom(pom, edits)
+
+    assert applied == edits
+    assert text == NAMESPACED_POM.replace('0.8.100', '0.8.380')
+    assert prbot_script.verify_pom_patch(pom, text, applied)
+
+
+def test_patch_pom_skips_edit_of_changed_value():
+    pom = prbot_script.Pom('pom.xml', NAMESPACED_POM)
+    edit = prbot_script.PomEdit('pom.xml', HELIOS_XPATH, '0.8.99', '0.8.380',
+                                None, pom.spans[HELIOS_XPATH])
+
+    text, applied = prbot_script.patch_pom(pom, [edit])
+
+    assert text == NAMESPACED_POM
+    assert applied == []
+
+
+def test_verify_pom_patch_rejects_other_changes():
+    pom = prbot_script.Pom('pom.xml', PARENT_POM)
+    edit = prbot_script.PomEdit('pom.xml', 'helios.version', '0.8.100',
+                                '0.8.380', None,
+                                pom.property_spans['helios.version'])
+    text, applied = prbot_script.patch_pom(pom, [edit])
+
+    assert prbot_script.verify_pom_patch(pom, text, applied)
+    assert not prbot_script.verify_pom_patch(
+        pom, text.replace('4.12', '4.13'), applied)
+    assert not prbot_script.verify_pom_patch(pom, text[:-20], applied)
@@ -0,0 +1,62 @@
+import logging
+import subprocess
+
+from prbot import MATCH_LITERAL
+from prbot import Matcher
+from prbot import WorkerLogBuffer
+from prbot import logger
+from prbot import rewrite_tree
+
+
+def git_repo(tmpdir, files):
+    for path, text in files.items():
+        tmpdir.join(path).write(text, ensure=True)
+    subprocess.check_call(['git', 'init', '-q', str(tmpdir)])
+    subprocess.check_call(['git', 'add', '-A'], cwd=str(tmpdir))
+    return tmpdir
+
+
+def test_grep_tree(tmpdir, monkeypatch):
+    for name in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv('GIT_%s_NAME' % name, 'test')
+        monkeypatch.setenv('GIT_%s_EMAIL' % name, 'test@example.com')
+    repo = git_repo(tmpdir, {'pom.xml': 'foo-1', 'sub/pom.xml': 'foo-2',
+                             'README.md': 'foo-3', 'other.xml': 'bar'})
+    subprocess.check_call(['git', 'commit', '-q', '-m', 'Add files'],
+                          cwd=str(repo))
+    repo.join('pom.xml').write('bar')
+    matcher = Matcher(r'foo-\d', 'bar', paths='*.xml')
+
+    assert matcher.grep_tree(str(repo)) == ['sub/pom.xml']
+    assert sorted(matcher.grep_tree(str(repo), 'HEAD')) == \
+        ['pom.xml', 'sub/pom.xml']
+
+
+def test_rewrite_tree_chains_rules(tmpdir):
+    repo = git_repo(tmpdir, {'pom.xml': 'foo-1 foo-2', 'notes.txt': 'foo-3',
+                             'other.xml': 'nothing'})
+    matchers = [Matcher('foo', 'bar', MATCH_LITERAL),
+                Matcher(r'bar-(\d)', r'baz-\1', paths='*.xml')]
+
+    counts = rewrite_tree(str(repo), matchers, workers=2)
+
+    assert counts == {'pom.xml': 4, 'notes.txt': 1}
+    assert repo.join('pom.xml').read() == 'baz-1 baz-2'
+    assert repo.join('notes.txt').read() == 'bar-3'
+    assert repo.join('other.xml').read() == 'nothing'
+
+
+def test_rewrite_tree_logs_from_calling_thread(tmpdir, monkeypatch):
+    repo = git_repo(tmpdir, {'a.txt': 'foo', 'b.txt': 'foo foo'})
+    monkeypatch.setattr(logger, 'level', logging.INFO)
+    log_buffer = WorkerLogBuffer()
+    logger.addFilter(log_buffer)
+    try:
+        with log_buffer.capture() as records:
+            rewrite_tree(str(repo), [Matcher('foo', 'bar')], workers=2)
+    finally:
+        logger.removeFilter(log_buffer)
+
+    messages = [r.getMessage() for r in records]
+    assert 'Found 1 matches of old string "foo" in a.txt. Editing' in messages
+    assert 'Found 2 matches of old string "foo" in b.txt. Editing' in messages
@@ -0,0 +1,96 @@
+import imp
+import os
+import re
+import urllib
+from datetime import date
+
+prbot_script = imp.load_source(
+    'prbot_script',
+    os.path.join(os.path.dirname(__file__), os.pardir, 'prbot.py'))
+
+SearchShard = prbot_script.SearchShard
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, total_count):
+        self.total_count = total_count
+
+    def json(self):
+        return {'total_count': self.total_count, 'items': []}
+
+
+def shard_dates(url):
+    query = urllib.unquote(re.search(r'q=([^&]*)', url).group(1))
+    return re.search(r'pushed:(\S+?)\.\.(\S+?)(\+|$)', query).group(1, 2)
+
+
+def test_query():
+    shard = SearchShard(date(2020, 1, 1), date(2020, 1, 31), 0, 1024,
+                        lang='java')
+
+    assert shard.query() == \
+        'pushed:2020-01-01..2020-01-31+size:0..1024+language:java'
+    assert SearchShard(date(2020, 1, 1), date(2020, 1, 2), 2048).query() == \
+        'pushed:2020-01-01..2020-01-02+size:>=2048'
+
+
+def test_split_halves_dates():
+    first, second = SearchShard(date(2020, 1, 1), date(2020, 1, 4)).split()
+
+    assert (first.pushed_from, first.pushed_to) == \
+        (date(2020, 1, 1), date(2020, 1, 2))
+    assert (second.pushed_from, second.pushed_to) == \
+        (date(2020, 1, 3), date(2020, 1, 4))
+
+
+def test_split_single_day():
+    shard = SearchShard(date(2020, 1, 1), date(2020, 1, 1))
+
+    assert shard.split() is None
+    first, second = shard.split(by_size=True)
+    assert (first.size_from, first.size_to) == \
+        (0, prbot_script.SEARCH_SHARD_MIN_SIZE_KB)
+    assert (second.size_from, second.size_to) == \
+        (prbot_script.SEARCH_SHARD_MIN_SIZE_KB + 1, None)
+
+    first, second = first.split(by_size=True)
+    assert (first.size_from, first.size_to) == (0, 512)
+    assert (second.size_from, second.size_to) == (513, 1024)
+    assert SearchShard(date(2020, 1, 1), date(2020, 1, 1), 5, 5).split(
+        by_size=True) is None
+
+
+def test_plan_repo_search_splits_shards_over_limit(monkeypatch):
+    counts = {('2020-01-01', '2020-01-04'): 1500,
+              ('2020-01-01', '2020-01-02'): 900,
+              ('2020-01-03', '2020-01-04'): 600}
+    requested = []
+
+    def github_request(method, url, **kwargs):
+        requested.append(shard_dates(url))
+        return FakeResponse(counts[shard_dates(url)])
+
+    monkeypatch.setattr(prbot_script, 'github_request', github_request)
+    shard = SearchShard(date(2020, 1, 1), date(2020, 1, 4))
+
+    planned = list(prbot_script.plan_repo_search(
+        'https://api.github.com/', shard, by_size=False))
+
+    assert sorted(shard_dates(url) for url, _ in planned) == \
+        [('2020-01-01', '2020-01-02'), ('2020-01-03', '2020-01-04')]
+    assert sorted(r.total_count for _, r in planned) == [600, 900]
+    assert len(requested) == 3
+
+
+def test_plan_repo_search_keeps_shard_that_cant_be_split(monkeypatch):
+    monkeypatch.setattr(prbot_script, 'github_request',
+                        lambda method, url, **kwargs: FakeResponse(5000))
+    shard = SearchShard(date(2020, 1, 1), date(2020, 1, 1))
+
+    planned = list(prbot_script.plan_repo_search(
+        'https://api.github.com/', shard, by_size=False))
+
+    assert [shard_dates(url) for url, _ in planned] == \
+        [('2020-01-01', '2020-01-01')]